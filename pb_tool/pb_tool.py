@@ -23,12 +23,37 @@ import os
 import sys
 import subprocess
 import shutil
+import select
+import time
+import ctypes
+import ctypes.util
+import threading
+import Queue
+import ast
+import tokenize
 import errno
+import fnmatch
 import glob
+import hashlib
+import json
+import re
+import struct
+import tempfile
+import zipfile
+import zlib
+from collections import deque
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
 import urllib2
 import ConfigParser
 from string import Template
-from distutils.dir_util import copy_tree
+from xml.etree import ElementTree
+from xml.parsers import expat
+from xml.sax.saxutils import escape, quoteattr
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
 
 import click
 
@@ -75,14 +100,101 @@ def __version():
 
 
 def get_install_files(cfg):
-    python_files = cfg.get('files', 'python_files').split()
-    main_dialog = cfg.get('files', 'main_dialog').split()
-    extras = cfg.get('files', 'extras').split()
+    python_files = file_list(cfg, 'python_files')
+    main_dialog = file_list(cfg, 'main_dialog')
+    extras = file_list(cfg, 'extras')
     # merge the file lists
     install_files = python_files + main_dialog + compiled_ui(
         cfg) + compiled_resource(cfg) + extras
     # click.echo(install_files)
-    return install_files
+    return unique(install_files)
+
+
+def file_list(cfg, option):
+    """ Return the files named by option in the [files] section of cfg.
+    Entries holding wildcards are glob patterns matched against
+    file_index(), where ** stands for any number of directories, and an
+    entry starting with ! drops the files listed before it that it matches.
+    Other entries are taken as they are. """
+    files = []
+    for entry in cfg.get('files', option).split():
+        if entry.startswith('!'):
+            match = glob_regex(entry[1:]).match
+            files = [path for path in files
+                     if not match(os.path.normpath(path).replace(os.sep, '/'))]
+        elif GLOB_CHARS.search(entry):
+            match = glob_regex(entry).match
+            files.extend(path for path in file_index()
+                         if match(path.replace(os.sep, '/')))
+        else:
+            files.append(entry)
+    return unique(files)
+
+
+GLOB_CHARS = re.compile(r'[*?[]')
+
+
+def glob_regex(pattern):
+    """ Compile the glob pattern into a regular expression for paths with
+    / separators. A ** component matches any number of directories, the
+    other wildcards stay within one name and, as with glob, none of them
+    match a name starting with a dot. """
+    name = r'(?!\.)[^/]+'
+    parts = os.path.normpath(pattern).replace(os.sep, '/').split('/')
+    regex = ''
+    for (index, part) in enumerate(parts):
+        if part == '**':
+            if index == len(parts) - 1:
+                regex += r'{0}(?:/{0})*'.format(name)
+            else:
+                regex += r'(?:{0}/)*'.format(name)
+            continue
+        if GLOB_CHARS.match(part):
+            regex += r'(?!\.)'
+        position = 0
+        while position < len(part):
+            char = part[position]
+            position += 1
+            if char == '*':
+                regex += '[^/]*'
+            elif char == '?':
+                regex += '[^/]'
+            elif char == '[' and ']' in part[position + 1:]:
+                end = part.index(']', position + 1)
+                chars = part[position:end]
+                position = end + 1
+                if chars.startswith('!'):
+                    chars = '^' + chars[1:]
+                regex += '[{0}]'.format(chars.replace('\\', '\\\\'))
+            else:
+                regex += re.escape(char)
+        if index < len(parts) - 1:
+            regex += '/'
+    return re.compile(regex + r'\Z')
+
+
+_file_index = {}
+
+
+def file_index():
+    """ Return the sorted paths of the files under the current directory.
+    The tree is walked the first time only; reset_file_index() makes the
+    next call walk it again. """
+    top = os.getcwd()
+    if top not in _file_index:
+        _file_index[top] = sorted(tree_files(top))
+    return _file_index[top]
+
+
+def reset_file_index():
+    """ Forget the files found by file_index() """
+    _file_index.clear()
+
+
+def unique(items):
+    """ Return items without the repeats, in the order first seen """
+    seen = set()
+    return [item for item in items if not (item in seen or seen.add(item))]
 
 
 @cli.command()
@@ -96,8 +208,9 @@ def version():
               default='pb_tool.cfg',
               help='Name of the config file to use if other than pb_tool.cfg')
 @click.option('--plugin_path', '-p',
-              default=None,
-              help='Specify the directory where to deploy your plugin if not using the standard location')
+              multiple=True,
+              help='Specify the directory where to deploy your plugin if not using the standard location.'
+                   ' Repeat it to deploy to several directories at once')
 @click.option('--quick', '-q',
               is_flag=True,
               help='Do a quick install without compiling ui, resource, docs, \
@@ -105,125 +218,803 @@ def version():
 @click.option('--no-confirm', '-y',
               is_flag=True,
               help='Don\'t ask for confirmation to overwrite existing files')
-def deploy(config_file, plugin_path, quick, no_confirm):
+@click.option('--jobs', '-j',
+              default=cpu_count(),
+              type=click.IntRange(1, None),
+              help='Number of build steps to run at the same time'
+                   ' (defaults to the number of CPUs)')
+@click.option('--sync', '-s',
+              is_flag=True,
+              help='Update the deployed plugin in place, copying only changed'
+                   ' files and removing stale ones')
+@click.option('--checksum',
+              is_flag=True,
+              help='With --sync, compare file contents instead of size and'
+                   ' modification time')
+@click.option('--link-mode',
+              default='copy',
+              type=click.Choice(['copy', 'reflink', 'hardlink', 'auto']),
+              help='How to put files in place: copy them, share their data'
+                   ' with reflinks or hard links, or use the best the'
+                   ' filesystem supports (auto)')
+@click.option('--dev-link',
+              is_flag=True,
+              help='Fill the plugin directory with links to your source files'
+                   ' instead of copies, so edits need no deploy')
+def deploy(config_file, plugin_path, quick, no_confirm, jobs, sync, checksum,
+           link_mode, dev_link):
     """Deploy the plugin to QGIS plugin directory using parameters in pb_tool.cfg"""
-    deploy_files(config_file, plugin_path, quick=quick, confirm=not no_confirm)
+    if dev_link:
+        if not hasattr(os, 'symlink'):
+            click.secho("Symbolic links are not supported on this platform",
+                        fg='red')
+            return
+        link_mode = 'symlink'
+    deploy_files(config_file, plugin_path, quick=quick, confirm=not no_confirm,
+                 jobs=jobs, sync=sync, checksum=checksum, link_mode=link_mode)
 
 
-def deploy_files(config_file, plugin_path, confirm=True, quick=False):
-    """Deploy the plugin using parameters in pb_tool.cfg"""
+def deploy_files(config_file, plugin_path=(), confirm=True, quick=False, jobs=1,
+                 sync=False, checksum=False, link_mode='copy'):
+    """Deploy the plugin using parameters in pb_tool.cfg to the plugin
+    directory in each of plugin_path (see plugin_directories)"""
     # check for the config file
     if not os.path.exists(config_file):
         click.secho("Configuration file {0} is missing.".format(config_file),
                     fg='red')
     else:
         cfg = get_config(config_file)
-        if not plugin_path:
-            plugin_path = get_plugin_directory()
-            if not plugin_path:
-                click.secho("Unable to determine where to deploy your plugin", fg='red')
-                return
-
-        plugin_dir = os.path.join(plugin_path, cfg.get('plugin', 'name'))
+        plugin_dirs = plugin_directories(cfg, plugin_path)
+        if not plugin_dirs:
+            click.secho("Unable to determine where to deploy your plugin", fg='red')
+            return
 
         if quick:
             click.secho("Doing quick deployment", fg='green')
-            install_files(plugin_dir, cfg)
+            for plugin_dir in plugin_dirs:
+                install_files(plugin_dir, cfg, link_mode, jobs)
             click.secho(
                 "Quick deployment complete---if you have problems with your"
                 " plugin, try doing a full deploy.", fg='green')
 
         else:
-            if confirm:
+            if sync:
+                # nothing is removed up front, so there's nothing to confirm
+                proceed = True
+            elif confirm:
                 print """Deploying will:
-                * Remove your currently deployed version
                 * Compile the ui and resource files
                 * Build the help docs
-                * Copy everything to your {} directory
-                """.format(plugin_dir)
+                * Copy everything to a staging directory
+                * Replace your currently deployed version in your {} directory
+                """.format(', '.join(plugin_dirs))
 
                 proceed = click.confirm("Proceed?")
             else:
                 proceed = True
 
             if proceed:
-                # clean the deployment
-                clean_deployment(False, config_file, plugin_dir)
-                click.secho("Deploying to {0}".format(plugin_dir), fg='green')
+                for plugin_dir in plugin_dirs:
+                    click.secho("Deploying to {0}".format(plugin_dir),
+                                fg='green')
                 # compile to make sure everything is fresh
                 click.secho('Compiling to make sure install is clean',
                             fg='green')
-                compile_files(cfg)
-                build_docs()
-                install_files(plugin_dir, cfg)
+                cache = BuildCache()
+                try:
+                    results = build_targets(
+                        cache, deploy_targets(cfg, cache, plugin_dirs, jobs,
+                                              sync, checksum, link_mode),
+                        jobs)
+                finally:
+                    # whatever didn't make it into place is thrown away
+                    for plugin_dir in plugin_dirs:
+                        if os.path.lexists(staging_dir(plugin_dir)):
+                            remove_tree(staging_dir(plugin_dir))
+                cache.save()
+                stopped = [plugin_dir for plugin_dir in plugin_dirs
+                           if results[plugin_dir] != 'built']
+                if stopped:
+                    click.secho("Deployment to {0} stopped---fix the errors"
+                                " above and deploy again".format(
+                                    ', '.join(stopped)), fg='red')
+                    if not sync:
+                        click.secho("The deployed plugin was left as it was",
+                                    fg='red')
+                if 'failed' in results.values():
+                    sys.exit(1)
+
+
+def deploy_targets(cfg, cache, plugin_dirs, jobs=1, sync=False,
+                   checksum=False, link_mode='copy'):
+    """ Return the targets for a full deployment to each of plugin_dirs:
+    everything that gets compiled or built, which is only built once, and
+    for each plugin directory a copy of each file or directory that is
+    installed and the deployed plugin itself.
+
+    Each copy only depends on the target that builds what it copies, so
+    files are copied as soon as they are ready while the help or other
+    files are still being built, and to every plugin directory at once.
+
+    Everything is copied to a staging directory which replaces the plugin
+    directory once it is complete, so the deployed plugin is never missing
+    or half copied and a failed build leaves it untouched. With sync, the
+    plugin directory is updated in place instead, only copying the files
+    that differ from the deployed ones (see Installer).
+    """
+    targets = (compile_targets(cfg, cache) + translation_targets(cfg) +
+               docs_targets(jobs))
+    built = [target for target in targets]
+    for plugin_dir in plugin_dirs:
+        targets += install_targets(cfg, built, plugin_dir, sync, checksum,
+                                   link_mode)
+    return targets
+
+
+def install_targets(cfg, built, plugin_dir, sync=False, checksum=False,
+                    link_mode='copy'):
+    """ Return the targets that copy the plugin to plugin_dir once what it
+    depends on in built is up to date, and finish the deployment there.
+
+    The targets already run on the build_targets pool, so each copies its
+    directory one file at a time rather than starting threads of its own.
+    """
+    if sync:
+        install_dir = plugin_dir
+    else:
+        install_dir = staging_dir(plugin_dir)
+        if os.path.lexists(install_dir):
+            # left behind by a deployment that was interrupted
+            remove_tree(install_dir)
+    installer = Installer(install_dir, sync, checksum, link_mode)
+    copies = []
+    for file in get_install_files(cfg):
+        copies.append(Target(
+            os.path.join(plugin_dir, file), 'copy', [file],
+            [os.path.join(plugin_dir, file)],
+            lambda target, file=file: installer.install_file(file),
+            deps=producers(built, file), label=file, message='',
+            cached=False))
+    for xdir in cfg.get('files', 'extra_dirs').split():
+        copies.append(Target(
+            os.path.join(plugin_dir, xdir), 'copy', [xdir],
+            [os.path.join(plugin_dir, xdir)],
+            lambda target, xdir=xdir: installer.install_dir(
+                xdir, xdir,
+                "contents of {0} to {1}".format(xdir, plugin_dir),
+                "Error copying directory"),
+            deps=producers(built, xdir), label=xdir, message='',
+            cached=False))
+    help_src = cfg.get('help', 'dir')
+    help_target = os.path.join(plugin_dir, cfg.get('help', 'target'))
+    copies.append(Target(
+        help_target, 'copy', [help_src], [help_target],
+        lambda target: installer.install_dir(
+            help_src, cfg.get('help', 'target'),
+            "{0} to {1}".format(help_src, help_target),
+            "Error copying help files"),
+        deps=producers(built, help_src), label=help_src, message='',
+        cached=False))
+
+    def finish_deployment(target):
+        # files that fail to copy are reported once everything is copied
+        # but, as they always have been, don't stop the deployment
+        installer.finish(cfg)
+        if not sync:
+            swap_in(install_dir, plugin_dir)
+
+    return copies + [Target(plugin_dir, 'deploy', [], [plugin_dir],
+                            finish_deployment,
+                            deps=[target.name for target in copies],
+                            message="Deployed to {0}".format(plugin_dir),
+                            cached=False)]
+
+
+def plugin_directories(cfg, plugin_paths=()):
+    """ Return the directories to deploy the plugin to: its directory in
+    each of plugin_paths or, if none are given, in each of the paths listed
+    in the plugin_path option of the config, or else in the QGIS default
+    location. The paths in the config are separated by os.pathsep or put on
+    lines of their own, so they may contain spaces. Paths that lead to the
+    same directory are only deployed to once. """
+    if isinstance(plugin_paths, basestring):
+        plugin_paths = [plugin_paths]
+    paths = [path for path in plugin_paths]
+    if not paths:
+        paths = [path.strip() for line in
+                 get_option(cfg, 'plugin', 'plugin_path', '').splitlines()
+                 for path in line.split(os.pathsep) if path.strip()]
+    if not paths:
+        default = get_plugin_directory(qgis_version(cfg))
+        if not default:
+            return []
+        paths = [default]
+    name = cfg.get('plugin', 'name')
+    plugin_dirs = []
+    seen = set()
+    for path in paths:
+        plugin_dir = os.path.join(os.path.expanduser(path), name)
+        if os.path.realpath(plugin_dir) not in seen:
+            seen.add(os.path.realpath(plugin_dir))
+            plugin_dirs.append(plugin_dir)
+    return plugin_dirs
+
+
+def staging_dir(plugin_dir):
+    """ Return the directory a deployment to plugin_dir is put together in.
+    It is next to plugin_dir so it can be renamed into its place. """
+    (parent, name) = os.path.split(os.path.normpath(plugin_dir))
+    return os.path.join(parent, '.{0}.pb_tool-staging'.format(name))
+
+
+def swap_in(staging, plugin_dir):
+    """ Replace plugin_dir with the staging directory and remove the
+    previous deployment. Where the system supports it the two directories
+    are exchanged in a single atomic rename, otherwise the old deployment
+    is renamed out of the way first. """
+    make_dirs(staging)
+    if not os.path.lexists(plugin_dir):
+        os.rename(staging, plugin_dir)
+        return
+    if exchange_paths(staging, plugin_dir):
+        remove_tree(staging)
+        return
+    old = staging + '-old'
+    if os.path.lexists(old):
+        remove_tree(old)
+    os.rename(plugin_dir, old)
+    os.rename(staging, plugin_dir)
+    remove_tree(old)
+
+
+# renameat2() flag that swaps the two paths
+RENAME_EXCHANGE = 2
+AT_FDCWD = -100
+
+
+def exchange_paths(first, second):
+    """ Atomically swap two paths with Linux renameat2, returning False if
+    the system or filesystem can't """
+    try:
+        rename = libc().renameat2
+    except (OSError, AttributeError):
+        return False
+    rename.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int,
+                       ctypes.c_char_p, ctypes.c_uint]
+    if rename(AT_FDCWD, first.encode(sys.getfilesystemencoding()), AT_FDCWD,
+              second.encode(sys.getfilesystemencoding()),
+              RENAME_EXCHANGE) == 0:
+        return True
+    errno_ = ctypes.get_errno()
+    if errno_ in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+        return False
+    raise OSError(errno_, os.strerror(errno_))
+
+
+def libc():
+    """ Return the C library, for the system calls Python doesn't wrap """
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                            use_errno=True)
+    return _libc
+
+
+_libc = None
+
+
+def producers(targets, path):
+    """ Return the names of the targets that build path or anything in or
+    containing it """
+    path = os.path.normpath(path)
+    names = []
+    for target in targets:
+        for output in target.outputs:
+            output = os.path.normpath(output)
+            if (output == path or output.startswith(path + os.sep) or
+                    path.startswith(output + os.sep)):
+                names.append(target.name)
+                break
+    return names
+
+
+def install_files(plugin_dir, cfg, link_mode='copy', jobs=1, sync=False):
+    installer = Installer(plugin_dir, sync, link_mode=link_mode, jobs=jobs)
+    installer.install_files(get_install_files(cfg))
+    for xdir in cfg.get('files', 'extra_dirs').split():
+        installer.install_dir(
+            xdir, xdir,
+            "contents of {0} to {1}".format(xdir, plugin_dir),
+            "Error copying directory")
+    help_src = cfg.get('help', 'dir')
+    help_target = os.path.join(plugin_dir,
+                               cfg.get('help', 'target'))
+    installer.install_dir(help_src, cfg.get('help', 'target'),
+                          "{0} to {1}".format(help_src, help_target),
+                          "Error copying help files")
+    return installer.finish(cfg)
+
+
+def install_paths(cfg):
+    """ Return the paths, relative to the plugin directory, of every file
+    and directory a deployment of the plugin contains. Directories that
+    don't exist aren't deployed, so they are left out. """
+    paths = set(os.path.normpath(file) for file in get_install_files(cfg))
+    trees = [(xdir, xdir) for xdir in cfg.get('files', 'extra_dirs').split()]
+    trees.append((cfg.get('help', 'dir'), cfg.get('help', 'target')))
+    for (src, dest) in trees:
+        if not os.path.isdir(src):
+            continue
+        paths.add(os.path.normpath(dest))
+        for path in tree_files(src, include_dirs=True):
+            paths.add(os.path.normpath(os.path.join(dest, path)))
+    for path in [path for path in paths]:
+        # the directories holding the files are part of it too
+        parent = os.path.dirname(path)
+        while parent:
+            paths.add(parent)
+            parent = os.path.dirname(parent)
+    return paths
+
+
+# names never copied out of a directory tree: byte code, version control
+# metadata and the files editors leave behind
+EXCLUDE_PATTERNS = ('__pycache__', '*.pyc', '*.pyo', '.git', '.svn', '.hg',
+                    '.DS_Store', '*.swp', '*.swo', '*~', '.#*')
+
+
+def exclude_matcher(patterns):
+    """ Compile the fnmatch patterns into a single regular expression and
+    return its match method, which tests a file or directory name """
+    if not patterns:
+        return lambda name: None
+    return re.compile('|'.join(
+        '(?:{0})'.format(fnmatch.translate(pattern))
+        for pattern in patterns)).match
+
+
+EXCLUDE = exclude_matcher(EXCLUDE_PATTERNS)
+
+
+def scan_tree(top, exclude=EXCLUDE):
+    """ Return (path, is_dir) for everything under top that exclude does
+    not match, with paths relative to top. Each directory is read once and
+    its entries are listed in sorted order ahead of those of its children.
+    Like copy_tree, links to directories are followed. """
+    found = []
+    pending = [(top, '')]
+    while pending:
+        (path, rel) = pending.pop()
+        entries = sorted((entry.name, entry.is_dir())
+                         for entry in scandir(path)
+                         if not exclude(entry.name))
+        subdirs = []
+        for (name, is_dir) in entries:
+            found.append((os.path.join(rel, name), is_dir))
+            if is_dir:
+                subdirs.append((os.path.join(path, name),
+                                os.path.join(rel, name)))
+        pending.extend(reversed(subdirs))
+    return found
+
+
+def tree_files(top, include_dirs=False, exclude=EXCLUDE):
+    """ Return the paths, relative to top, of the files under top, along
+    with the directories if include_dirs """
+    return [path for (path, is_dir) in scan_tree(top, exclude)
+            if include_dirs or not is_dir]
+
+
+def copy_dir(src, dest, exclude=EXCLUDE):
+    """ Copy the tree at src to dest, leaving out whatever exclude matches.
+    Directories are created as they are needed each time, so repeated
+    copies recreate anything removed from dest in between. """
+    found = scan_tree(src, exclude)
+    make_dirs(dest)
+    for (path, is_dir) in found:
+        if is_dir:
+            make_dirs(os.path.join(dest, path))
+        else:
+            shutil.copy2(os.path.join(src, path), os.path.join(dest, path))
+
+
+def make_dirs(path):
+    """ Create the directory path along with any missing parents """
+    try:
+        os.makedirs(path)
+    except OSError as oops:
+        if oops.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
 
 
-def install_files(plugin_dir, cfg):
-    errors = []
-    install_files = get_install_files(cfg)
-    # make the plugin directory if it doesn't exist
-    if not os.path.exists(plugin_dir):
-        os.makedirs(plugin_dir)
+class Installer(object):
+    """ Copies the files of a plugin into plugin_dir and collects the
+    errors, so they can be reported together once everything is copied.
 
-    fail = False
-    for file in install_files:
-        click.secho("Copying {0}".format(file), fg='magenta', nl=False)
+    With sync, files whose size and mtime match the deployed copy (or,
+    with checksum, whose contents match) are left as they are, and finish
+    removes whatever is deployed but no longer part of the plugin. That
+    leaves the same result as a clean deploy while only copying what
+    changed.
+
+    link_mode is how files are put in place; see install_copy. With
+    symlink the plugin directory links to the files and directories in
+    the source tree instead (see deploy --dev-link).
+    """
+
+    def __init__(self, plugin_dir, sync=False, checksum=False,
+                 link_mode='copy', jobs=1):
+        self.plugin_dir = plugin_dir
+        self.jobs = jobs
+        self.sync = sync
+        self.checksum = checksum
+        self.link_mode = link_mode
+        self.errors = []
+        self.copied = 0
+        self.unchanged = 0
+        self.methods = {}
+        # the paths installed, for the manifest
+        self.installed = set()
+        self.lock = threading.Lock()
+        if link_mode == 'symlink':
+            self.verb = 'Linking'
+        else:
+            self.verb = 'Copying'
+
+    def install_file(self, file):
+        """ Copy file to the same path in the plugin directory """
+        self.report_file(*self.copy_file(file))
+
+    def install_files(self, files):
+        """ Copy files to the plugin directory using up to jobs threads,
+        reporting them in the order they are listed """
+        for result in run_jobs(self.copy_file, files, self.jobs):
+            self.report_file(*result)
+
+    def copy_file(self, file):
+        """ Copy file and return (file, whether it was copied, error) """
         try:
-            shutil.copy(file, os.path.join(plugin_dir, file))
-            print ""
-        except Exception as oops:
-            errors.append(
-                "Error copying files: {0}, {1}".format(file, oops.strerror))
-            click.echo(click.style(' ----> ERROR', fg='red'))
-            fail = True
-        extra_dirs = cfg.get('files', 'extra_dirs').split()
-        # print "EXTRA DIRS: {}".format(extra_dirs)
-    for xdir in extra_dirs:
-        click.secho("Copying contents of {0} to {1}".format(xdir, plugin_dir),
-                    fg='magenta',
-                    nl=False)
+            return (file, self.copy(file, file), None)
+        except EnvironmentError as oops:
+            return (file, False, oops.strerror)
+
+    def report_file(self, file, copied, error):
+        if error:
+            self.error("Error copying files: {0}, {1}".format(file, error),
+                       "{0} {1}".format(self.verb, file))
+        elif copied:
+            click.secho("{0} {1}".format(self.verb, file), fg='magenta')
+
+    def install_dir(self, src, dest, description, error_prefix):
+        """ Copy the contents of the src directory to dest in the plugin
+        directory, printing description if anything was copied. When
+        linking, dest becomes a link to src itself. """
+        description = "{0} {1}".format(self.verb, description)
+        if not os.path.isdir(src):
+            self.error("{0}: {1}, cannot copy tree '{1}': not a "
+                       "directory".format(error_prefix, src), description)
+            return
+        copied = False
         try:
-            copy_tree(xdir, "{0}/{1}".format(plugin_dir, xdir))
+            if self.link_mode == 'symlink':
+                copied = self.copy(src, dest)
+            else:
+                found = scan_tree(src)
+                self.make_dir(dest)
+                for path in [path for (path, is_dir) in found if is_dir]:
+                    self.make_dir(os.path.join(dest, path))
+                copied = any([result for result in run_jobs(
+                    lambda path: self.copy(os.path.join(src, path),
+                                           os.path.join(dest, path)),
+                    [path for (path, is_dir) in found if not is_dir],
+                    self.jobs)])
+        except EnvironmentError as oops:
+            self.error("{0}: {1}, {2}".format(error_prefix, src,
+                                              oops.strerror), description)
+            return
+        if copied or not self.sync:
+            click.secho(description, fg='magenta')
+
+    def copy(self, src, path):
+        """ Copy src to path in the plugin directory, unless syncing and
+        the deployed file is already the same. Returns True if src was
+        copied. """
+        dest = os.path.join(self.plugin_dir, path)
+        self.make_dir(os.path.dirname(path))
+        if self.sync and self.same(src, dest):
+            with self.lock:
+                self.unchanged += 1
+                self.installed.add(os.path.normpath(path))
+            return False
+        # never write through a link into the file it shares data with
+        if os.path.isdir(dest) and not os.path.islink(dest):
+            remove_tree(dest)
+        elif os.path.islink(dest) or (
+                os.path.exists(dest) and (self.link_mode != 'copy' or
+                                          os.stat(dest).st_nlink > 1)):
+            os.unlink(dest)
+        method = install_copy(src, dest, self.link_mode)
+        with self.lock:
+            self.copied += 1
+            self.methods[method] = self.methods.get(method, 0) + 1
+            self.installed.add(os.path.normpath(path))
+        return True
+
+    def make_dir(self, path):
+        """ Create the directory path in the plugin directory. Links to
+        directories on the way to it, which deploy --dev-link leaves behind,
+        are replaced by real directories first, so nothing is ever copied
+        or removed through them in the source tree. """
+        target = os.path.join(self.plugin_dir, path)
+        real = os.path.normpath(os.path.join(
+            os.path.realpath(self.plugin_dir), path))
+        if os.path.realpath(target) != real:
+            current = self.plugin_dir
+            for part in os.path.normpath(path).split(os.sep):
+                current = os.path.join(current, part)
+                with self.lock:
+                    if os.path.islink(current):
+                        remove_tree(current)
+        make_dirs(target)
+
+    def same(self, src, dest):
+        """ Return True if dest already has the contents of src """
+        if self.link_mode == 'symlink':
+            return (os.path.islink(dest) and
+                    os.readlink(dest) == os.path.abspath(src))
+        if os.path.islink(dest):
+            # left by --dev-link; stat would compare src with itself
+            return False
+        try:
+            deployed = os.stat(dest)
+        except OSError:
+            return False
+        st = os.stat(src)
+        if st.st_size != deployed.st_size:
+            return False
+        if not self.checksum:
+            return int(st.st_mtime) == int(deployed.st_mtime)
+        if file_sha1(src) != file_sha1(dest):
+            return False
+        # keep the next stat-only sync from having to look at it again
+        shutil.copystat(src, dest)
+        return True
+
+    def error(self, message, description):
+        with self.lock:
+            self.errors.append(message)
+        click.echo(click.style(description, fg='magenta') +
+                   click.style(' ----> ERROR', fg='red'))
+
+    def finish(self, cfg):
+        """ Remove stale files when syncing, write the manifest and report
+        the errors from copying the plugin files, returning True if there
+        were none """
+        if self.sync:
+            removed = self.remove_stale(install_paths(cfg) | set([MANIFEST]))
+            click.secho("Copied {0} files, {1} were up to date and {2} were"
+                        " removed".format(self.copied, self.unchanged,
+                                          removed), fg='green')
+        if self.link_mode != 'copy' and self.methods:
+            click.secho("Deployed files by {0}".format(", ".join(
+                "{0} ({1})".format(method, count)
+                for (method, count) in sorted(self.methods.items()))),
+                fg='green')
+        if os.path.isdir(self.plugin_dir):
+            write_manifest(self.plugin_dir, self.installed)
+        if self.errors:
+            print "\nERRORS:"
+            for error in self.errors:
+                print error
             print ""
-        except Exception as oops:
-            errors.append(
-                "Error copying directory: {0}, {1}".format(xdir, oops.message))
-            click.echo(click.style(' ----> ERROR', fg='red'))
-            fail = True
-    help_src = cfg.get('help', 'dir')
-    help_target = os.path.join(plugin_dir,
-                               cfg.get('help', 'target'))
-    click.secho("Copying {0} to {1}".format(help_src, help_target),
-                fg='magenta',
-                nl=False)
-    # shutil.copytree(help_src, help_target)
+            print(
+                "One or more files/directories specified in your config file\n"
+                "failed to deploy---make sure they exist or if not needed remove\n"
+                "them from the config. To ensure proper deployment, make sure your\n"
+                "UI and resource files are compiled. Using dclean to delete the\n"
+                "plugin before deploying may also help.")
+        return not self.errors
+
+    def remove_stale(self, paths):
+        """ Remove everything in the plugin directory that isn't in paths,
+        returning the number of files removed """
+        removed = 0
+        for (root, dirs, files) in os.walk(self.plugin_dir, topdown=False):
+            rel = os.path.relpath(root, self.plugin_dir)
+            for name in files + [name for name in dirs
+                                 if os.path.islink(os.path.join(root, name))]:
+                path = os.path.normpath(os.path.join(rel, name))
+                if path not in paths:
+                    click.secho("Removing {0}".format(path), fg='magenta')
+                    os.unlink(os.path.join(root, name))
+                    removed += 1
+            for name in dirs:
+                path = os.path.normpath(os.path.join(rel, name))
+                full = os.path.join(root, name)
+                if (path not in paths and not os.path.islink(full) and
+                        not os.listdir(full)):
+                    os.rmdir(full)
+        return removed
+
+
+# ioctl that makes a file share the data of another (btrfs, XFS, ...)
+FICLONE = 0x40049409
+# errors meaning the filesystem can't clone or link a file, so it is copied
+NO_LINK_ERRORS = (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+                  errno.EPERM, errno.ENOSYS, errno.EMLINK, errno.EBADF)
+
+
+def install_copy(src, dest, link_mode='copy'):
+    """ Put a copy of src at dest, which must not exist unless link_mode is
+    copy, and return how it was done.
+
+    reflink shares the data of src using FICLONE and hardlink makes dest a
+    hard link to src, so large files are deployed without duplicating
+    them. auto tries reflink, then copy_file_range (which lets the kernel
+    copy, or share, the data without passing it through pb_tool). Whenever
+    the filesystem can't do it the file is copied as usual.
+
+    symlink makes dest a symbolic link to src and never falls back to a
+    copy. A missing src raises ENOENT rather than leaving a dangling link.
+    """
+    if link_mode == 'symlink':
+        if not os.path.lexists(src):
+            raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), src)
+        os.symlink(os.path.abspath(src), dest)
+        return 'symlink'
+    if link_mode == 'hardlink':
+        methods = [('hardlink', os.link)]
+    elif link_mode == 'reflink':
+        methods = [('reflink', reflink_file)]
+    elif link_mode == 'auto':
+        methods = [('reflink', reflink_file),
+                   ('copy_file_range', copy_file_range)]
+    else:
+        methods = []
+    for (name, method) in methods:
+        try:
+            method(src, dest)
+            if name != 'hardlink':
+                shutil.copystat(src, dest)
+            return name
+        except EnvironmentError as oops:
+            if oops.errno not in NO_LINK_ERRORS:
+                raise
+    shutil.copy2(src, dest)
+    return 'copy'
+
+
+def reflink_file(src, dest):
+    """ Make dest a clone of src sharing its data """
     try:
-        copy_tree(help_src, help_target)
-        print ""
-    except Exception as oops:
-        errors.append("Error copying help files: {0}, {1}".format(
-            help_src, oops.message))
-        click.echo(click.style(' ----> ERROR', fg='red'))
-        fail = True
-    if fail:
-        print "\nERRORS:"
-        for error in errors:
-            print error
-        print ""
-        print(
-            "One or more files/directories specified in your config file\n"
-            "failed to deploy---make sure they exist or if not needed remove\n"
-            "them from the config. To ensure proper deployment, make sure your\n"
-            "UI and resource files are compiled. Using dclean to delete the\n"
-            "plugin before deploying may also help.")
-
-
-def clean_deployment(ask_first=True, config='pb_tool.cfg', plugin_dir=None):
-    """ Remove the deployed plugin from the .qgis2/python/plugins directory
+        import fcntl
+    except ImportError:
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+    with open(src, 'rb') as source, open(dest, 'wb') as clone:
+        fcntl.ioctl(clone.fileno(), FICLONE, source.fileno())
+
+
+def copy_file_range(src, dest):
+    """ Copy src to dest with the copy_file_range system call """
+    try:
+        copy_range = libc().copy_file_range
+    except (OSError, AttributeError):
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+    copy_range.restype = ctypes.c_ssize_t
+    copy_range.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                           ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+    with open(src, 'rb') as source, open(dest, 'wb') as copy:
+        remaining = os.fstat(source.fileno()).st_size
+        while remaining > 0:
+            count = copy_range(source.fileno(), None, copy.fileno(), None,
+                               remaining, 0)
+            if count < 0:
+                errno_ = ctypes.get_errno()
+                raise OSError(errno_, os.strerror(errno_))
+            if count == 0:
+                break
+            remaining -= count
+
+
+MANIFEST = '.pb_tool-manifest.json'
+MANIFEST_VERSION = 1
+
+
+def write_manifest(plugin_dir, paths):
+    """ Record the size, mtime and sha1 of each of paths (relative to
+    plugin_dir) in the manifest of the plugin. Links are recorded with the
+    path they point to. Files whose size and mtime match the manifest
+    already there aren't read again. """
+    manifest = read_manifest(plugin_dir) or {}
+    files = {}
+    for path in sorted(paths):
+        full = os.path.join(plugin_dir, path)
+        if os.path.islink(full):
+            files[path] = {'link': os.readlink(full)}
+            continue
+        st = os.stat(full)
+        known = manifest.get(path, {})
+        if known.get('size') == st.st_size and known.get('mtime') == st.st_mtime:
+            files[path] = known
+        else:
+            files[path] = {'size': st.st_size, 'mtime': st.st_mtime,
+                           'sha1': file_sha1(full)}
+    with open(os.path.join(plugin_dir, MANIFEST), 'w') as f:
+        json.dump({'version': MANIFEST_VERSION, 'files': files}, f,
+                  indent=1, sort_keys=True)
+
+
+def update_manifest(plugin_dir, paths):
+    """ Bring the manifest of plugin_dir up to date after the files at
+    paths in it were changed in place, dropping the files that are gone.
+    A deployment without a manifest is left without one. """
+    manifest = read_manifest(plugin_dir)
+    if manifest is None:
+        return
+    paths = set(manifest) | set(os.path.normpath(path) for path in paths)
+    write_manifest(plugin_dir, [path for path in paths if os.path.lexists(
+        os.path.join(plugin_dir, path))])
+
+
+def read_manifest(plugin_dir):
+    """ Return the files recorded in the manifest of the plugin deployed in
+    plugin_dir, or None if there is no usable manifest """
+    try:
+        with open(os.path.join(plugin_dir, MANIFEST)) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if manifest.get('version') != MANIFEST_VERSION:
+        return None
+    return manifest.get('files', {})
+
+
+def remove_tree(path):
+    """ Remove path and, if it is a directory, everything in it. Symbolic
+    links are removed without following them, so a linked deployment never
+    touches the source files it links to. Returns the number of links that
+    were removed. """
+    if os.path.islink(path) or not os.path.isdir(path):
+        links = 1 if os.path.islink(path) else 0
+        os.unlink(path)
+        return links
+    links = 0
+    for (root, dirs, files) in os.walk(path, topdown=False):
+        for name in files + dirs:
+            full = os.path.join(root, name)
+            if os.path.islink(full):
+                os.unlink(full)
+                links += 1
+            elif name in files:
+                os.unlink(full)
+            else:
+                os.rmdir(full)
+    os.rmdir(path)
+    return links
+
+
+def file_sha1(path):
+    """ Return the sha1 of the contents of path """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def clean_deployment(ask_first=True, config='pb_tool.cfg', plugin_dir=None,
+                     plugin_paths=()):
+    """ Remove the deployed plugin from plugin_dir or, if it isn't given,
+    from every directory it is deployed to
+    (see plugin_directories for plugin_paths)
     """
     if not plugin_dir:
-        name = get_config(config).get('plugin', 'name')
-        plugin_dir = os.path.join(get_plugin_directory(), name)
+        removed = True
+        for plugin_dir in plugin_directories(get_config(config),
+                                             plugin_paths):
+            if not clean_deployment(ask_first, config, plugin_dir):
+                removed = False
+        return removed
     if ask_first:
         proceed = click.confirm(
             'Delete the deployed plugin from {0}?'.format(plugin_dir))
@@ -233,7 +1024,10 @@ def clean_deployment(ask_first=True, config='pb_tool.cfg', plugin_dir=None):
     if proceed:
         click.echo('Removing plugin from {0}'.format(plugin_dir))
         try:
-            shutil.rmtree(plugin_dir)
+            links = remove_tree(plugin_dir)
+            if links:
+                click.echo('Removed {0} links to your source files (the'
+                           ' files themselves were not touched)'.format(links))
             return True
         except OSError as oops:
             print 'Plugin was not deleted: {0}'.format(oops.strerror)
@@ -265,10 +1059,92 @@ def clean_docs():
 @click.option('--config',
               default='pb_tool.cfg',
               help='Name of the config file to use if other than pb_tool.cfg')
-def dclean(config):
-    """ Remove the deployed plugin from the .qgis2/python/plugins directory
+@click.option('--plugin_path', '-p',
+              multiple=True,
+              help='Specify the directory the plugin was deployed to if not using the standard location.'
+                   ' Repeat it to remove it from several directories')
+def dclean(config, plugin_path):
+    """ Remove the deployed plugin from the QGIS plugin directory
     """
-    clean_deployment(True, config)
+    clean_deployment(True, config, plugin_paths=plugin_path)
+
+
+@cli.command()
+@click.option('--config',
+              default='pb_tool.cfg',
+              help='Name of the config file to use if other than pb_tool.cfg')
+@click.option('--plugin_path', '-p',
+              multiple=True,
+              help='Specify the directory your plugin is deployed to if not'
+                   ' the standard location. Repeat it to check several')
+@click.option('--hash', 'use_hash',
+              is_flag=True,
+              help='Compare the contents of every file instead of only its'
+                   ' size and modification time')
+def verify(config, plugin_path, use_hash):
+    """ Check the deployed plugin against the manifest written when it was
+    deployed, listing missing, modified and extra files"""
+    drifted = False
+    for plugin_dir in plugin_directories(get_config(config), plugin_path):
+        manifest = read_manifest(plugin_dir)
+        if manifest is None:
+            click.secho("No deployment manifest found in {0}---deploy the"
+                        " plugin first".format(plugin_dir), fg='red')
+            drifted = True
+            continue
+        (missing, modified, extra) = verify_deployment(plugin_dir, manifest,
+                                                       use_hash)
+        for (label, paths) in (('Missing', missing), ('Modified', modified),
+                               ('Extra', extra)):
+            for path in paths:
+                click.secho("{0}: {1}".format(label, path), fg='red')
+        if missing or modified or extra:
+            click.secho("{0} missing, {1} modified and {2} extra files in"
+                        " {3}".format(len(missing), len(modified), len(extra),
+                                      plugin_dir), fg='red')
+            drifted = True
+        else:
+            click.secho("{0} matches its manifest ({1} files)".format(
+                plugin_dir, len(manifest)), fg='green')
+    if drifted:
+        sys.exit(1)
+
+
+def verify_deployment(plugin_dir, manifest, use_hash=False):
+    """ Compare plugin_dir with the files recorded in its manifest and
+    return sorted lists of the (missing, modified, extra) paths """
+    missing = []
+    modified = []
+    for (path, entry) in sorted(manifest.items()):
+        full = os.path.join(plugin_dir, path)
+        if not os.path.lexists(full):
+            missing.append(path)
+        elif 'link' in entry:
+            if not os.path.islink(full) or os.readlink(full) != entry['link']:
+                modified.append(path)
+        elif os.path.islink(full) or not os.path.isfile(full):
+            modified.append(path)
+        elif use_hash:
+            if file_sha1(full) != entry['sha1']:
+                modified.append(path)
+        else:
+            st = os.stat(full)
+            if st.st_size != entry['size'] or st.st_mtime != entry['mtime']:
+                modified.append(path)
+    known = set(manifest)
+    known.add(MANIFEST)
+    extra = []
+    for (root, dirs, files) in os.walk(plugin_dir):
+        # nor is the byte code Python writes when QGIS loads the plugin
+        dirs[:] = [name for name in dirs if not EXCLUDE(name)]
+        rel = os.path.relpath(root, plugin_dir)
+        for name in [name for name in files if not EXCLUDE(name)] + [
+                name for name in dirs
+                if os.path.islink(os.path.join(root, name))]:
+            path = os.path.normpath(os.path.join(rel, name))
+            if path not in known:
+                extra.append(path)
+    return (missing, modified, sorted(extra))
 
 
 @cli.command()
@@ -293,43 +1169,153 @@ def clean(config):
 @click.option('--config',
               default='pb_tool.cfg',
               help='Name of the config file to use if other than pb_tool.cfg')
-def compile(config):
+@click.option('--jobs', '-j',
+              default=1,
+              type=click.IntRange(1, None),
+              help='Number of files to compile at the same time')
+def compile(config, jobs):
     """
     Compile the resource and ui files
     """
-    compile_files(get_config(config))
+    if not compile_files(get_config(config), jobs):
+        sys.exit(1)
 
 
 @cli.command()
-def doc():
+@click.option('--jobs', '-j',
+              default=1,
+              type=click.IntRange(1, None),
+              help='Number of processes sphinx reads the sources with')
+def doc(jobs):
     """ Build HTML version of the help files using sphinx"""
-    build_docs()
+    cache = BuildCache()
+    results = build_targets(cache, docs_targets(jobs))
+    cache.save()
+    if 'failed' in results.values():
+        sys.exit(1)
+
+
+def docs_targets(jobs=1):
+    """ Return the target that builds the HTML help, if there is any. It is
+    skipped while nothing in help/source has changed. """
+    if not os.path.exists('help'):
+        print "No help directory exists in the current directory"
+        return []
+    version = sphinx_version()
+    if version:
+        identity = 'sphinx ' + version
+    else:
+        identity = docs_make_program()
+    return [Target(os.path.join('help', 'build', 'html'), 'docs',
+                   [os.path.join('help', 'source')],
+                   [os.path.join('help', 'build', 'html')],
+                   lambda target: build_docs(jobs), identity=identity,
+                   label=os.path.join('help', 'source'),
+                   message="Built the help documentation")]
 
 
-def build_docs():
+def docs_make_program():
+    if sys.platform == 'win32':
+        return 'make.bat'
+    return 'make'
+
+
+def sphinx_version():
+    """ Return the Sphinx version if the docs can be built with the Sphinx
+    installed for this Python, or None if they have to be built with make """
+    try:
+        import sphinx
+        from sphinx.application import Sphinx
+    except ImportError:
+        return None
+    return sphinx.__version__
+
+
+def build_docs(jobs=1):
     """ Build the docs using sphinx"""
     if os.path.exists('help'):
         click.echo('Building the help documentation')
-        if sys.platform == 'win32':
-            makeprg = 'make.bat'
-        else:
-            makeprg = 'make'
-        cwd = os.getcwd()
-        os.chdir('help')
-        subprocess.check_call([makeprg, 'html'])
-        os.chdir(cwd)
+        if sphinx_version():
+            build_sphinx('help', jobs)
+            return
+        # the docs build runs alongside other targets, so it must not
+        # change the working directory of the process
+        subprocess.check_call([docs_make_program(), 'html'],
+                              cwd=os.path.abspath('help'))
     else:
         print "No help directory exists in the current directory"
 
 
+def build_sphinx(help_dir, jobs=1):
+    """ Build the HTML help the same way `make html` does, but without
+    needing make. The doctrees are kept in build/doctrees as the Makefile
+    keeps them, so sphinx only rereads the sources that changed.
+
+    Sphinx changes the working directory while it reads conf.py, which
+    would pull it from under the targets building at the same time, so it
+    runs in a process of its own and is given absolute paths. """
+    source = os.path.abspath(os.path.join(help_dir, 'source'))
+    build = os.path.abspath(os.path.join(help_dir, 'build'))
+    command = [sys.executable, '-m', 'sphinx', '-b', 'html',
+               '-d', os.path.join(build, 'doctrees')]
+    if jobs > 1:
+        command += ['-j', str(jobs)]
+    subprocess.check_call(command + [source, os.path.join(build, 'html')])
+
+
 @cli.command()
 @click.option('--config',
               default='pb_tool.cfg',
               help='Name of the config file to use if other than pb_tool.cfg')
-def translate(config):
+@click.option('--jobs', '-j',
+              default=1,
+              type=click.IntRange(1, None),
+              help='Number of locales to release at the same time')
+def translate(config, jobs):
     """ Build translations using lrelease. Locales must be specified
     in the config file and the corresponding .ts file must exist in
-    the i18n directory of your plugin."""
+    the i18n directory of your plugin. Locales whose .ts file hasn't
+    changed since it was last released are skipped."""
+    cfg = get_config(config)
+    if check_cfg(cfg, 'files', 'locales'):
+        if cfg.get('files', 'locales').split():
+            if not translate_files(cfg, jobs=jobs):
+                sys.exit(1)
+        else:
+            print "No translations are specified in {0}".format(config)
+
+
+def translate_files(cfg, locales=None, jobs=1):
+    """ Release the translations for locales, or for every locale in the
+    config, running up to jobs lrelease processes at the same time, and
+    print the outcome for each locale. Returns False if any failed. """
+    if locales is None:
+        locales = get_option(cfg, 'files', 'locales', '').split()
+    cache = BuildCache()
+    targets = translation_targets(cfg, locales)
+    # one locale failing doesn't stop the others
+    results = build_targets(cache, targets, jobs, keep_going=True)
+    cache.save()
+    if targets:
+        status = {'built': 'released', 'skipped': 'up to date',
+                  'failed': 'FAILED', 'not built': 'not released'}
+        click.echo("Translation summary:")
+        for locale in locales:
+            result = results.get(locale_file(locale, '.qm'))
+            click.secho("  {0:<10} {1}".format(
+                os.path.splitext(os.path.basename(locale_file(locale)))[0],
+                status.get(result, 'no .ts file')),
+                fg='red' if result == 'failed' else None)
+    return 'failed' not in results.values()
+
+
+def translation_targets(cfg, locales=None):
+    """ Return the targets that release the .qm file of locales, or of
+    every locale in the config, using lrelease """
+    if locales is None:
+        locales = get_option(cfg, 'files', 'locales', '').split()
+    if not locales:
+        return []
     possibles = ['lrelease', 'lrelease-qt4']
     for binary in possibles:
         cmd = check_path(binary)
@@ -342,20 +1328,692 @@ def translate(config):
             print('You can get lrelease by installing'
                   ' the qt4-devel package in the Libs'
                   '\nsection of the OSGeo4W Advanced Install.')
+        return []
+    targets = []
+    for locale in locales:
+        ts_file = locale_file(locale)
+        qm_file = locale_file(locale, '.qm')
+        if not os.path.exists(ts_file):
+            print "{0} does not exist---skipped".format(ts_file)
+            continue
+        targets.append(Target(
+            qm_file, 'translation', [ts_file], [qm_file],
+            lambda target, ts_file=ts_file: subprocess.check_call(
+                [cmd, ts_file]),
+            identity=cmd, label=ts_file,
+            message="Released {0} to {1}".format(ts_file, qm_file)))
+    return targets
+
+
+def locale_file(locale, ext='.ts'):
+    """ Return the path in the i18n directory of the .ts (or other ext)
+    file for a locale listed in the config """
+    (name, locale_ext) = os.path.splitext(locale)
+    if locale_ext != '.ts':
+        name = locale
+    return os.path.join('i18n', name + ext)
+
+
+@cli.command()
+@click.option('--config',
+              default='pb_tool.cfg',
+              help='Name of the config file to use if other than pb_tool.cfg')
+@click.option('--no-obsolete',
+              is_flag=True,
+              help='Drop strings that are no longer in the sources instead'
+                   ' of marking them obsolete')
+def strings(config, no_obsolete):
+    """ Update the .ts files of your locales with the strings to translate
+    in your Python and ui files. Only files that changed since the last
+    run are scanned again and .ts files are only written if their strings
+    changed."""
+    cfg = get_config(config)
+    locales = get_option(cfg, 'files', 'locales', '').split()
+    if not locales:
+        print "No translations are specified in {0}".format(config)
+        return
+    cache = BuildCache()
+    messages = []
+    unchanged = 0
+    sources = (file_list(cfg, 'python_files') +
+               file_list(cfg, 'main_dialog') +
+               file_list(cfg, 'compiled_ui_files'))
+    for source in sources:
+        if not os.path.exists(source):
+            print "{0} does not exist---skipped".format(source)
+            continue
+        known = cache.data['messages'].get(source)
+        if known and known[0] == cache.file_hash(source):
+            unchanged += 1
+        if source.endswith('.ui'):
+            messages += cache.parsed('messages', source, ui_strings)
+        else:
+            messages += cache.parsed('messages', source, python_strings)
+    click.echo("Found {0} strings in {1} files ({2} unchanged)".format(
+        len(messages), len(sources), unchanged))
+    cache.save()
+    for locale in locales:
+        ts_file = locale_file(locale)
+        try:
+            (added, obsolete) = update_ts(ts_file, messages, no_obsolete)
+        except ElementTree.ParseError as oops:
+            click.secho("Unable to update {0}: {1}".format(ts_file, oops),
+                        fg='red')
+            continue
+        if added is None:
+            click.echo("{0} is up to date".format(ts_file))
+        else:
+            click.secho("Updated {0}: {1} new, {2} no longer used".format(
+                ts_file, added, obsolete), fg='green')
+
+
+def python_strings(path):
+    """ Return [context, source text, filename, line] for each literal
+    string passed to tr() or translate() in a Python file. The context of
+    tr() is the class it is called in. """
+    with open(path) as f:
+        try:
+            tokens = [token for token in tokenize.generate_tokens(f.readline)
+                      if token[0] not in (tokenize.NL, tokenize.COMMENT)]
+        except (tokenize.TokenError, IndentationError) as oops:
+            click.secho("Unable to scan {0} for strings: {1}".format(
+                path, oops), fg='red')
+            return []
+    messages = []
+    classes = []
+    depth = 0
+    pending_class = None
+    for (index, token) in enumerate(tokens):
+        (kind, text, (line, col)) = token[:3]
+        if kind == tokenize.INDENT:
+            depth += 1
+            if pending_class:
+                classes.append((depth, pending_class))
+                pending_class = None
+        elif kind == tokenize.DEDENT:
+            depth -= 1
+            while classes and classes[-1][0] > depth:
+                classes.pop()
+        elif kind == tokenize.NAME and text == 'class':
+            pending_class = tokens[index + 1][1]
+        elif (kind == tokenize.NAME and text in ('tr', 'translate') and
+              tokens[index - 1][1] != 'def' and
+              tokens[index + 1][1] == '('):
+            args = call_arguments(tokens, index + 2)
+            if text == 'tr' and len(args) >= 1 and args[0] is not None:
+                context = classes[-1][1] if classes else '@default'
+                messages.append([context, args[0], path, line])
+            elif (text == 'translate' and len(args) >= 2 and
+                  None not in args[:2]):
+                messages.append([args[0], args[1], path, line])
+    return messages
+
+
+def call_arguments(tokens, start):
+    """ Return the arguments of the call whose argument tokens begin at
+    start: the value of arguments made only of string literals and None
+    for anything else """
+    args = []
+    value = u''
+    literal = True
+    level = 0
+    for token in tokens[start:]:
+        (kind, text) = token[:2]
+        if kind == tokenize.OP and text in '([{' and text:
+            level += 1
+        elif kind == tokenize.OP and text in ')]}' and text:
+            if level == 0:
+                break
+            level -= 1
+        if level == 0 and kind == tokenize.OP and text == ',':
+            args.append(value if literal and value else None)
+            value = u''
+            literal = True
+        elif kind == tokenize.STRING and level == 0:
+            string = ast.literal_eval(text)
+            if isinstance(string, bytes):
+                string = string.decode('utf-8')
+            value += string
+        else:
+            literal = False
+    args.append(value if literal and value else None)
+    return args
+
+
+def ui_strings(path):
+    """ Return [context, source text, filename, line] for each translatable
+    string in a ui file. The context is the class of the form. """
+    messages = []
+    state = {'stack': [], 'text': None, 'line': 0, 'class': '',
+             'translatable': True}
+    parser = expat.ParserCreate()
+
+    def start(tag, attrs):
+        state['stack'].append(tag)
+        if tag in ('string', 'class'):
+            state['text'] = u''
+            state['line'] = parser.CurrentLineNumber
+            state['translatable'] = attrs.get('notr') != 'true'
+
+    def end(tag):
+        state['stack'].pop()
+        if tag == 'class' and state['stack'] == ['ui']:
+            state['class'] = state['text'].strip()
+        elif tag == 'string' and state['translatable'] and state['text']:
+            messages.append([state['class'], state['text'], path,
+                             state['line']])
+        state['text'] = None
+
+    def data(text):
+        if state['text'] is not None:
+            state['text'] += text
+
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    parser.CharacterDataHandler = data
+    try:
+        with open(path, 'rb') as f:
+            parser.ParseFile(f)
+    except expat.ExpatError as oops:
+        click.secho("Unable to scan {0} for strings: {1}".format(path, oops),
+                    fg='red')
+    return messages
+
+
+def update_ts(ts_file, messages, no_obsolete=False):
+    """ Merge messages into a .ts file, keeping existing translations.
+
+    New strings are added as unfinished translations and strings that are
+    no longer found are marked obsolete (or dropped if no_obsolete). The
+    file is only written if it changes. Returns (added, obsolete) counts,
+    or (None, None) if the file was already up to date.
+    """
+    if os.path.exists(ts_file):
+        with open(ts_file, 'rb') as f:
+            original = f.read()
+        root = ElementTree.fromstring(original)
     else:
-        cfg = get_config(config)
-        if check_cfg(cfg, 'files', 'locales'):
-            locales = cfg.get('files', 'locales').split()
-            if locales:
-                for locale in locales:
-                    (name, ext) = os.path.splitext(locale)
-                    if ext != '.ts':
-                        print 'no ts extension'
-                        locale = name + '.ts'
-                    print cmd, locale
-                    subprocess.check_call([cmd, os.path.join('i18n', locale)])
-            else:
-                print "No translations are specified in {0}".format(config)
+        original = None
+        language = os.path.splitext(os.path.basename(ts_file))[0]
+        root = ElementTree.Element('TS', {'version': '2.0',
+                                          'language': language,
+                                          'sourcelanguage': 'en'})
+    contexts = {}
+    for context in root.findall('context'):
+        contexts[context.findtext('name')] = context
+
+    # group the locations of each (context, source) in source order
+    found = {}
+    order = []
+    for (context, source, path, line) in messages:
+        key = (context, source)
+        if key not in found:
+            found[key] = []
+            order.append(key)
+        found[key].append((os.path.relpath(path, os.path.dirname(ts_file))
+                           .replace(os.sep, '/'), line))
+
+    seen = set()
+    added = 0
+    obsolete = 0
+    for context in root.findall('context'):
+        name = context.findtext('name')
+        for message in context.findall('message'):
+            key = (name, message.findtext('source'))
+            translation = message.find('translation')
+            if translation is None:
+                translation = ElementTree.SubElement(message, 'translation')
+            if key in found:
+                seen.add(key)
+                set_locations(message, found[key])
+                if translation.get('type') == 'obsolete':
+                    if translation.text:
+                        del translation.attrib['type']
+                    else:
+                        translation.set('type', 'unfinished')
+            elif no_obsolete:
+                context.remove(message)
+                obsolete += 1
+            elif translation.get('type') != 'obsolete':
+                translation.set('type', 'obsolete')
+                for location in message.findall('location'):
+                    message.remove(location)
+                obsolete += 1
+        if context.find('message') is None:
+            root.remove(context)
+            del contexts[name]
+    for key in order:
+        if key in seen:
+            continue
+        (name, source) = key
+        if name not in contexts:
+            contexts[name] = ElementTree.SubElement(root, 'context')
+            ElementTree.SubElement(contexts[name], 'name').text = name
+        message = ElementTree.SubElement(contexts[name], 'message')
+        set_locations(message, found[key])
+        ElementTree.SubElement(message, 'source').text = source
+        ElementTree.SubElement(message, 'translation',
+                               {'type': 'unfinished'})
+        added += 1
+
+    content = ts_document(root)
+    if content == original:
+        return (None, None)
+    if not os.path.isdir(os.path.dirname(ts_file)):
+        os.makedirs(os.path.dirname(ts_file))
+    with open(ts_file, 'wb') as f:
+        f.write(content)
+    return (added, obsolete)
+
+
+def set_locations(message, locations):
+    """ Replace the <location> elements of a message """
+    for location in message.findall('location'):
+        message.remove(location)
+    for (index, (filename, line)) in enumerate(locations):
+        message.insert(index, ElementTree.Element(
+            'location', {'filename': filename, 'line': str(line)}))
+
+
+def ts_document(root):
+    """ Return the contents of a .ts file laid out the way Qt writes it """
+    lines = ['<?xml version="1.0" encoding="utf-8"?>',
+             '<!DOCTYPE TS><TS{0}>'.format(ts_attributes(root))]
+    for context in root:
+        lines += ts_element(context, 0)
+    lines.append('</TS>')
+    return '\n'.join(lines).encode('utf-8') + b'\n'
+
+
+def ts_element(element, depth):
+    indent = u'    ' * depth
+    tag = u'<{0}{1}'.format(element.tag, ts_attributes(element))
+    children = [child for child in element]
+    if children:
+        lines = [indent + tag + u'>']
+        for child in children:
+            lines += ts_element(child, depth + 1)
+        return lines + [u'{0}</{1}>'.format(indent, element.tag)]
+    if element.tag == 'location':
+        return [indent + tag + u'/>']
+    return [u'{0}{1}>{2}</{3}>'.format(indent, tag,
+                                       escape(element.text or u''),
+                                       element.tag)]
+
+
+def ts_attributes(element):
+    # Qt writes the TS attributes in this order; others are sorted
+    order = ['version', 'language', 'sourcelanguage', 'filename', 'line']
+    names = sorted(element.keys(),
+                   key=lambda name: (order.index(name)
+                                     if name in order else len(order), name))
+    return u''.join(u' {0}={1}'.format(name, quoteattr(element.get(name)))
+                    for name in names)
+
+
+@cli.command()
+@click.option('--config',
+              default='pb_tool.cfg',
+              help='Name of the config file to use if other than pb_tool.cfg')
+@click.option('--plugin_path', '-p',
+              multiple=True,
+              help='Specify the directory where to deploy your plugin if not using the standard location.'
+                   ' Repeat it to deploy to several directories')
+@click.option('--delay',
+              default=0.5,
+              type=float,
+              help='Seconds to wait for a burst of changes to settle before rebuilding')
+@click.option('--poll',
+              is_flag=True,
+              help='Poll for changes instead of using inotify')
+@click.option('--jobs', '-j',
+              default=1,
+              type=click.IntRange(1, None),
+              help='Number of files to compile at the same time')
+def watch(config, plugin_path, delay, poll, jobs):
+    """ Watch the plugin sources, recompiling and deploying what changes """
+    cfg = get_config(config)
+    plugin_dirs = plugin_directories(cfg, plugin_path)
+
+    click.secho("Compiling and deploying to {0}".format(
+        ', '.join(plugin_dirs)), fg='green')
+    if not compile_files(cfg, jobs):
+        sys.exit(1)
+    for plugin_dir in plugin_dirs:
+        install_files(plugin_dir, cfg, deployed_link_mode(plugin_dir))
+
+    (files, dirs) = watch_sources(cfg)
+    files.add(os.path.normpath(config))
+    if poll or not sys.platform.startswith('linux'):
+        watcher = PollingWatcher(files, dirs)
+    else:
+        try:
+            watcher = InotifyWatcher(files, dirs)
+        except OSError as oops:
+            click.secho("inotify is unavailable ({0})---polling for changes"
+                        " instead".format(oops), fg='yellow')
+            watcher = PollingWatcher(files, dirs)
+    click.secho("Watching for changes (Ctrl-C to stop)", fg='green')
+    try:
+        while True:
+            changed = watcher.wait()
+            # a burst of saves becomes one rebuild once things go quiet
+            more = watcher.wait(delay)
+            while more:
+                changed |= more
+                more = watcher.wait(delay)
+            reload = os.path.normpath(config) in changed
+            if reload:
+                click.secho("Reloading {0}".format(config), fg='green')
+                cfg = get_config(config)
+                reset_file_index()
+            try:
+                redeploy_changes(cfg, plugin_dirs, changed, jobs)
+                if reload:
+                    redeploy_config(cfg, plugin_dirs, jobs)
+            except Exception as oops:
+                # keep watching, the next change may well fix it
+                click.secho("Redeploying failed: {0}".format(oops), fg='red')
+            # pick up files newly listed in the config or a qrc, or that
+            # now match one of its patterns
+            reset_file_index()
+            (files, dirs) = watch_sources(cfg)
+            files.add(os.path.normpath(config))
+            watcher.update(files, dirs)
+    except KeyboardInterrupt:
+        click.echo("Stopped watching")
+    finally:
+        watcher.close()
+
+
+def watch_sources(cfg):
+    """ Return the (files, directories) that watch keeps an eye on """
+    cache = BuildCache()
+    files = (file_list(cfg, 'python_files') +
+             file_list(cfg, 'main_dialog') +
+             file_list(cfg, 'extras') +
+             file_list(cfg, 'compiled_ui_files'))
+    files += [locale_file(locale)
+              for locale in get_option(cfg, 'files', 'locales', '').split()]
+    dirs = cfg.get('files', 'extra_dirs').split()
+    for qrc in file_list(cfg, 'resource_files'):
+        files.append(qrc)
+        if os.path.exists(qrc):
+            for (alias, path) in cache.resource_entries(qrc):
+                if os.path.isdir(path):
+                    dirs.append(path)
+                elif path:
+                    files.append(path)
+    if os.path.isdir(os.path.join('help', 'source')):
+        dirs.append(os.path.join('help', 'source'))
+    cache.save()
+    return (set(os.path.normpath(path) for path in files),
+            [os.path.normpath(path) for path in dirs])
+
+
+def redeploy_changes(cfg, plugin_dirs, changed, jobs=1):
+    """ Rebuild what depends on the changed files and copy the results,
+    and any changed files that are deployed as is, to each of plugin_dirs.
+
+    Failures are reported and the rest carries on. Files are copied by an
+    Installer, and nothing is copied to or removed from a plugin directory
+    where deploy --dev-link has linked the path to the source tree, which
+    already has the change.
+    """
+    cache = BuildCache()
+    compiled = compiled_ui(cfg) + compiled_resource(cfg)
+    compile_inputs = set(file_list(cfg, 'compiled_ui_files'))
+    for qrc in file_list(cfg, 'resource_files'):
+        compile_inputs.add(qrc)
+        if os.path.exists(qrc):
+            compile_inputs.update(cache.resource_files(qrc))
+    cache.save()
+    compile_inputs = set(os.path.normpath(path) for path in compile_inputs)
+    deployed_as_is = set(os.path.normpath(path) for path in (
+        file_list(cfg, 'python_files') +
+        file_list(cfg, 'main_dialog') +
+        file_list(cfg, 'extras')))
+    extra_dirs = [os.path.normpath(path)
+                  for path in cfg.get('files', 'extra_dirs').split()]
+    help_source = os.path.join('help', 'source')
+
+    updates = set()
+    if changed & compile_inputs:
+        before = dict((path, stat_key(path)) for path in compiled)
+        compile_files(cfg, jobs)
+        updates.update(path for path in compiled
+                       if stat_key(path) != before[path])
+    locales = [locale
+               for locale in get_option(cfg, 'files', 'locales', '').split()
+               if os.path.normpath(locale_file(locale)) in changed]
+    if locales:
+        released = [locale_file(locale, '.qm') for locale in locales]
+        before = dict((path, stat_key(path)) for path in released)
+        translate_files(cfg, locales)
+        updates.update(path for path in released
+                       if stat_key(path) != before[path])
+    installers = [Installer(plugin_dir) for plugin_dir in plugin_dirs]
+    touched = []
+    if any(path.startswith(help_source + os.sep) for path in changed):
+        help_src = cfg.get('help', 'dir')
+        help_target = cfg.get('help', 'target')
+        try:
+            build_docs()
+        except (subprocess.CalledProcessError, EnvironmentError) as oops:
+            click.secho("Building the help failed: {0}".format(oops),
+                        fg='red')
+        else:
+            for installer in installers:
+                if not linked_to_source(installer.plugin_dir, help_target):
+                    installer.install_dir(
+                        help_src, help_target, "{0} to {1}".format(
+                            help_src, os.path.join(installer.plugin_dir,
+                                                   help_target)),
+                        "Error copying help files")
+            if os.path.isdir(help_src):
+                touched = [os.path.join(help_target, path)
+                           for path in tree_files(help_src)]
+    for path in changed:
+        if path in deployed_as_is or (
+                any(path.startswith(xdir + os.sep) for xdir in extra_dirs)
+                and not any(EXCLUDE(name) for name in path.split(os.sep))):
+            updates.add(path)
+
+    for path in sorted(updates):
+        for installer in installers:
+            plugin_dir = installer.plugin_dir
+            target = os.path.join(plugin_dir, path)
+            if linked_to_source(plugin_dir, path):
+                continue
+            if os.path.isfile(path):
+                description = "Copying {0} to {1}".format(path, plugin_dir)
+                (file, copied, error) = installer.copy_file(path)
+                if error:
+                    installer.error("Error copying files: {0}, {1}".format(
+                        path, error), description)
+                else:
+                    click.secho(description, fg='magenta')
+            elif os.path.isfile(target):
+                click.secho("Removing {0} from {1}".format(path, plugin_dir),
+                            fg='magenta')
+                try:
+                    os.unlink(target)
+                except EnvironmentError as oops:
+                    installer.error("Error removing files: {0}, {1}".format(
+                        path, oops.strerror), "Removing {0} from {1}".format(
+                            path, plugin_dir))
+    for installer in installers:
+        update_manifest(installer.plugin_dir, [
+            path for path in touched + sorted(updates)
+            if not linked_to_source(installer.plugin_dir, path)])
+
+
+def redeploy_config(cfg, plugin_dirs, jobs=1):
+    """ Compile and deploy whatever the config now lists to each of
+    plugin_dirs, syncing them so that only what is new or changed is
+    copied and what the config no longer lists is removed """
+    compile_files(cfg, jobs)
+    for plugin_dir in plugin_dirs:
+        install_files(plugin_dir, cfg, deployed_link_mode(plugin_dir), jobs,
+                      sync=True)
+
+
+def deployed_link_mode(plugin_dir):
+    """ Return the link mode that keeps the deployment in plugin_dir as it
+    is: symlink if its manifest has links, as deploy --dev-link leaves,
+    otherwise copy """
+    manifest = read_manifest(plugin_dir) or {}
+    if any('link' in entry for entry in manifest.values()):
+        return 'symlink'
+    return 'copy'
+
+
+def linked_to_source(plugin_dir, path):
+    """ Return True if path in plugin_dir is, or is in, a link that deploy
+    --dev-link made to the source tree """
+    return os.path.realpath(os.path.join(plugin_dir, path)) != \
+        os.path.normpath(os.path.join(os.path.realpath(plugin_dir), path))
+
+
+def stat_key(path):
+    """ Return (size, mtime) for path, or None if it doesn't exist """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime)
+
+
+class PollingWatcher(object):
+    """ Detect changes to a set of files and directory trees by comparing
+    their size and mtime every interval seconds """
+
+    def __init__(self, files, dirs, interval=1.0):
+        self.interval = interval
+        self.update(files, dirs)
+
+    def update(self, files, dirs):
+        self.files = set(files)
+        self.dirs = tuple(dirs)
+        self.snapshot = self.scan()
+
+    def scan(self):
+        paths = set(self.files)
+        for xdir in self.dirs:
+            for (root, dirs, names) in os.walk(xdir):
+                paths.update(os.path.join(root, name) for name in names)
+        return dict((path, stat_key(path)) for path in paths)
+
+    def wait(self, timeout=None):
+        """ Return the paths changed since the last call, waiting up to
+        timeout seconds (forever if None) for something to change """
+        waited = 0
+        while True:
+            snapshot = self.scan()
+            changed = set(path for path in set(snapshot) | set(self.snapshot)
+                          if snapshot.get(path) != self.snapshot.get(path))
+            self.snapshot = snapshot
+            if changed or (timeout is not None and waited >= timeout):
+                return changed
+            pause = self.interval
+            if timeout is not None:
+                pause = min(pause, timeout - waited)
+            time.sleep(pause)
+            waited += pause
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """ Detect changes to a set of files and directory trees using Linux
+    inotify. The directories holding the files are watched, so editors that
+    save by renaming a new file over the old one are picked up too.
+    """
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_ISDIR = 0x40000000
+    MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+            IN_DELETE)
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, files, dirs):
+        self.libc = libc()
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            errno_ = ctypes.get_errno()
+            raise OSError(errno_, os.strerror(errno_))
+        self.watches = {}
+        self.update(files, dirs)
+
+    def update(self, files, dirs):
+        self.files = set(files)
+        self.dirs = tuple(dirs)
+        for path in self.files:
+            self.add_watch(os.path.dirname(path) or os.curdir)
+        for xdir in self.dirs:
+            for (root, subdirs, names) in os.walk(xdir):
+                self.add_watch(root)
+
+    def add_watch(self, directory):
+        if directory in self.watches.values() or not os.path.isdir(directory):
+            return
+        wd = self.libc.inotify_add_watch(self.fd, directory.encode(
+            sys.getfilesystemencoding()), self.MASK)
+        if wd >= 0:
+            self.watches[wd] = directory
+
+    def watched(self, path):
+        return path in self.files or any(
+            path.startswith(xdir + os.sep) for xdir in self.dirs)
+
+    def wait(self, timeout=None):
+        """ Return the watched paths changed since the last call, waiting up
+        to timeout seconds (forever if None) for something to change """
+        changed = set()
+        while not changed:
+            (ready, _, _) = select.select([self.fd], [], [], timeout)
+            if not ready:
+                break
+            data = os.read(self.fd, 65536)
+            offset = 0
+            while offset < len(data):
+                (wd, mask, cookie, length) = self.EVENT.unpack_from(data,
+                                                                    offset)
+                offset += self.EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if mask & self.IN_Q_OVERFLOW:
+                    # events were lost, so assume everything changed
+                    changed.update(self.files)
+                    continue
+                if wd not in self.watches:
+                    continue
+                path = os.path.normpath(os.path.join(
+                    self.watches[wd],
+                    name.decode(sys.getfilesystemencoding())))
+                if mask & self.IN_ISDIR:
+                    if mask & (self.IN_CREATE | self.IN_MOVED_TO) and \
+                            self.watched(path):
+                        # watch new directories in a watched tree
+                        for (root, subdirs, names) in os.walk(path):
+                            self.add_watch(root)
+                            changed.update(os.path.join(root, name)
+                                           for name in names)
+                elif self.watched(path):
+                    changed.add(path)
+        return changed
+
+    def close(self):
+        """ Stop watching, releasing the inotify file descriptor """
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
 
 
 @cli.command()
@@ -365,73 +2023,340 @@ def translate(config):
 @click.option(
     '--quick', '-q',
     is_flag=True,
-    help='Do a quick packaging without dclean and deploy (plugin must have been previously deployed)'
+    help='Do a quick packaging without compiling ui, resource, docs, and'
+         ' translation files first'
 )
-def zip(config_file, quick):
+@click.option('--jobs', '-j',
+              default=cpu_count(),
+              type=click.IntRange(1, None),
+              help='Number of build steps to run at the same time'
+                   ' (defaults to the number of CPUs)')
+@click.option('--reproducible', '-r',
+              is_flag=True,
+              help='Make the same sources always give an identical archive,'
+                   ' dated SOURCE_DATE_EPOCH if it is set')
+@click.option('--parallel', '-P',
+              is_flag=True,
+              help='Compress the files in as many processes as --jobs')
+def zip(config, quick, jobs, reproducible, parallel):
     """ Package the plugin into a zip file
     suitable for uploading to the QGIS
     plugin repository"""
-
-    # check to see if we can find zip or 7z
-    use_7z = False
-    zip = check_path('zip')
-    if not zip:
-        # check for 7z
-        zip = check_path('7z')
-        if not zip:
-            click.secho('zip or 7z not found. Unable to package the plugin',
-                        fg='red')
-            click.secho('Check your path or install a zip program', fg='red')
-            return
-        else:
-            use_7z = True
-    click.secho('Found zip: %s' % zip, fg='green')
-
-    name = get_config(config_file).get('plugin', 'name', fallback=None)
-    if not quick:
-        proceed = click.confirm('This requires a dclean and deploy first. Proceed?')
-        if proceed:
-            # clean_deployment(False, config)
-            deploy_files(config_file, plugin_path=None, confirm=False)
+    cfg = get_config(config)
+    name = get_option(cfg, 'plugin', 'name')
+    if not name:
+        click.echo(
+            "Your config file is missing the plugin name (name=parameter)")
+        return
+    date_time = None
+    if reproducible:
+        try:
+            date_time = archive_date_time()
+        except ValueError:
+            raise click.UsageError("SOURCE_DATE_EPOCH must be a number of"
+                                   " seconds since 1970")
+    cache = BuildCache()
+    if quick:
+        targets = []
     else:
-        # Check to see if the plugin directory exists, otherwise we can't
-        # do a quick zip
-        if not os.path.exists(os.path.join(get_plugin_directory(), name)):
-            # click.secho(
-            #     "You must deploy the plugin before you can package it using -q",
-            #     fg='red')
-            # proceed = click.confirm(
-            #     'Do you want to deploy and proceed with packaging?')
-            # if proceed:
-            deploy_files(config_file, plugin_path=None, confirm=False)
-        proceed = True
+        targets = (compile_targets(cfg, cache) + translation_targets(cfg) +
+                   docs_targets(jobs))
+    targets.append(zip_target(cfg, name, targets, date_time,
+                              jobs if parallel else 1))
+    results = build_targets(cache, targets, jobs)
+    cache.save()
+    if 'failed' in results.values():
+        sys.exit(1)
 
-    # confirm = click.confirm(
-    #    'Create a packaged plugin ({0}.zip) from the deployed files?'.format(name))
-    # confirm = True
-    if proceed:
-        # delete the zip if it exists
-        if os.path.exists('{0}.zip'.format(name)):
-            os.unlink('{0}.zip'.format(name))
-        if name:
-            cwd = os.getcwd()
-            os.chdir(get_plugin_directory())
-            # click.secho("Current directory is {}".format(os.getcwd()), fg='magenta')
-            if use_7z:
-                subprocess.check_call(
-                    [zip, 'a', '-r', os.path.join(cwd, '{0}.zip'.format(name)),
-                     name])
-            else:
-                subprocess.check_call([
-                    zip, '-r', os.path.join(cwd, '{0}.zip'.format(name)), name
-                ])
 
-            print(
-                'The {0}.zip archive has been created in the current directory'.format(
-                    name))
+def zip_target(cfg, name, built, date_time=None, processes=1):
+    """ Return the target that packages the plugin into name.zip in the
+    current directory once the targets in built are done """
+    archive = os.path.abspath('{0}.zip'.format(name))
+    return Target(archive, 'zip', [], [archive],
+                  lambda target: package_plugin(cfg, name, archive,
+                                                date_time, processes),
+                  deps=[target.name for target in built],
+                  label='{0}.zip'.format(name),
+                  message='The {0}.zip archive has been created in the'
+                          ' current directory'.format(name),
+                  cached=False)
+
+
+def package_plugin(cfg, name, archive, date_time=None, processes=1):
+    """ Write the files a deployment of the plugin would contain straight
+    from the source tree into the zip file archive, under a name directory.
+    The archive is written next to its final name and only replaces an
+    existing one once it is complete.
+
+    Given a date_time, the archive is reproducible: every entry gets that
+    date and fixed permissions, and the banners pyuic4 and pyrcc4 write
+    into the compiled modules are left out, so it only depends on the
+    contents of the files. Entries are always written in sorted order.
+
+    With more than one process, the files are compressed on a pool of that
+    many processes (see write_parallel), which gives the same archive.
+    """
+    compiled = set(os.path.normpath(path)
+                   for path in compiled_ui(cfg) + compiled_resource(cfg)
+                   if path.endswith('.py'))
+    (handle, partial) = tempfile.mkstemp(
+        prefix='.{0}.'.format(os.path.basename(archive)),
+        dir=os.path.dirname(archive))
+    os.close(handle)
+    try:
+        with zipfile.ZipFile(partial, 'w', zipfile.ZIP_DEFLATED,
+                             allowZip64=True) as package:
+            members = [(src, '/'.join([name] + path.split(os.sep))
+                        .rstrip('/'))
+                       for (src, path) in package_files(cfg)]
+            if processes > 1:
+                write_parallel(package, members, date_time,
+                               compiled if date_time else (), processes)
+            else:
+                write_members(package, members, date_time, compiled)
+        os.chmod(partial, 0o644)
+        if os.path.exists(archive):
+            # renaming onto an existing file fails on Windows
+            os.unlink(archive)
+        os.rename(partial, archive)
+    except BaseException:
+        os.unlink(partial)
+        raise
+
+
+def write_members(package, members, date_time=None, compiled=()):
+    """ Write the (source, arcname) members to the zip file package one at
+    a time, as reproducible entries given a date_time """
+    for (src, arcname) in members:
+        if date_time is None:
+            package.write(src, arcname)
+        elif os.path.isdir(src):
+            package.writestr(member_info(src, arcname + '/', date_time), '')
+        else:
+            write_file(package, member_info(src, arcname, date_time), src,
+                       os.path.normpath(src) in compiled)
+
+
+def write_file(package, info, src, strip=False):
+    """ Write the file src to the zip file package as the entry info,
+    streaming it through zlib in chunks, without its banner if strip. This
+    is ZipFile.write, which takes the date and mode of the entry from the
+    file itself, for a given ZipInfo. """
+    (info.CRC, info.file_size) = (0, os.path.getsize(src))
+    add_entry(package, info, deflate_chunks(src, info, strip))
+
+
+def deflate_chunks(src, info, strip=False):
+    """ Yield the contents of the file src deflated the way zipfile does
+    it, in chunks, without its banner if strip. The CRC and size of what
+    was deflated are set on info along with the last chunk. """
+    deflate = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    (crc, size) = (0, 0)
+    with open(src, 'rb') as f:
+        if strip:
+            # compiled modules are small, and stripping needs all of one
+            blocks = [strip_banner(f.read())]
+        else:
+            blocks = iter(lambda: f.read(65536), b'')
+        for block in blocks:
+            crc = zlib.crc32(block, crc)
+            size += len(block)
+            yield deflate.compress(block)
+    (info.CRC, info.file_size) = (crc & 0xffffffff, size)
+    yield deflate.flush()
+
+
+def add_entry(package, info, chunks):
+    """ Add the entry info to the zip file package with the deflated data
+    in chunks. info.file_size must be set, and info.CRC and file_size must
+    be right once chunks is used up.
+
+    zipfile can't add data that is already deflated, so this does what
+    ZipFile.write does in Python 2.7 with the same private members:
+    _writecheck (which also warns about a duplicate name), _didModify, fp,
+    filelist and NameToInfo. The local header is written first and again
+    once the CRC and sizes are known. Check it against zipfile before
+    moving to another version of Python.
+    """
+    zip64 = (package._allowZip64 and
+             info.file_size * 1.05 > zipfile.ZIP64_LIMIT)
+    info.header_offset = package.fp.tell()
+    package._writecheck(info)
+    package._didModify = True
+    info.compress_size = 0
+    package.fp.write(info.FileHeader(zip64))
+    for data in chunks:
+        info.compress_size += len(data)
+        package.fp.write(data)
+    if not zip64 and max(info.file_size,
+                         info.compress_size) > zipfile.ZIP64_LIMIT:
+        raise zipfile.LargeZipFile("Filesize would require ZIP64 extensions")
+    end = package.fp.tell()
+    package.fp.seek(info.header_offset)
+    package.fp.write(info.FileHeader(zip64))
+    package.fp.seek(end)
+    package.filelist.append(info)
+    package.NameToInfo[info.filename] = info
+
+
+# how many compressed files per process write_parallel holds at most
+PENDING_PER_PROCESS = 2
+# files larger than this are streamed by write_parallel rather than
+# deflated on the pool, which passes each one back whole
+PARALLEL_SIZE_LIMIT = 4 * 1024 * 1024
+
+
+def write_parallel(package, members, date_time=None, compiled=(),
+                   processes=1):
+    """ Write the (source, arcname) members to the zip file package in
+    order, deflating the files on a pool of processes. Each file is written
+    once it and those before it are done, and no more than
+    PENDING_PER_PROCESS files per process are compressed ahead of the one
+    being written. Files over PARALLEL_SIZE_LIMIT are streamed with
+    write_file when their turn comes, so the compressed data held at once
+    stays bounded however large the files are. Banners are stripped from
+    the files in compiled. """
+    pool = Pool(processes)
+    pending = deque()
+    try:
+        for (src, arcname) in members:
+            strip = os.path.normpath(src) in compiled
+            deflated = None
+            if os.path.isdir(src):
+                info = member_info(src, arcname + '/', date_time)
+            else:
+                info = member_info(src, arcname, date_time)
+                if os.path.getsize(src) <= PARALLEL_SIZE_LIMIT:
+                    deflated = pool.apply_async(deflate_file, (src, strip))
+            pending.append((info, src, deflated, strip))
+            if len(pending) > processes * PENDING_PER_PROCESS:
+                write_deflated(package, *pending.popleft())
+        while pending:
+            write_deflated(package, *pending.popleft())
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+
+def deflate_file(src, strip=False):
+    """ Return (crc, size, data) for the file src, data being its contents
+    deflated the way zipfile does it, without its banner if strip """
+    info = zipfile.ZipInfo()
+    data = b''.join(deflate_chunks(src, info, strip))
+    return (info.CRC, info.file_size, data)
+
+
+def write_deflated(package, info, src, deflated, strip=False):
+    """ Write src to the zip file package as the entry info: a directory if
+    src is one, otherwise with the data of the deflate_file result
+    deflated or, if there is none, streamed by write_file """
+    if os.path.isdir(src):
+        package.writestr(info, '')
+        return
+    if deflated is None:
+        write_file(package, info, src, strip)
+        return
+    # wait in short steps so Ctrl-C still works
+    while not deflated.ready():
+        deflated.wait(0.5)
+    (info.CRC, info.file_size, data) = deflated.get()
+    add_entry(package, info, [data])
+
+
+def member_info(src, arcname, date_time=None):
+    """ Return the ZipInfo for src, a directory if arcname ends with a
+    slash: an archive_entry given a date_time, otherwise with the time and
+    mode of src, as ZipFile.write gives it """
+    if date_time is not None:
+        return archive_entry(arcname, date_time,
+                             0o40755 if arcname.endswith('/') else 0o100644)
+    st = os.stat(src)
+    info = zipfile.ZipInfo(arcname, time.localtime(st.st_mtime)[:6])
+    info.external_attr = (st.st_mode & 0xFFFF) << 16
+    if arcname.endswith('/'):
+        info.external_attr |= 0x10
+    else:
+        info.compress_type = zipfile.ZIP_DEFLATED
+    return info
+
+
+def archive_date_time():
+    """ Return the date given to the entries of a reproducible archive:
+    SOURCE_DATE_EPOCH, the convention for reproducible builds, or the
+    earliest date a zip file can hold """
+    epoch = os.environ.get('SOURCE_DATE_EPOCH')
+    earliest = (1980, 1, 1, 0, 0, 0)
+    if not epoch:
+        return earliest
+    return max(tuple(time.gmtime(int(epoch))[:6]), earliest)
+
+
+def archive_entry(arcname, date_time, mode):
+    """ Return the ZipInfo for an entry of a reproducible archive, which
+    only depends on its name, date and Unix mode """
+    info = zipfile.ZipInfo(arcname, date_time)
+    info.create_system = 3
+    info.external_attr = mode << 16
+    if arcname.endswith('/'):
+        info.external_attr |= 0x10
+    else:
+        # zipfile always deflates at zlib's default level
+        info.compress_type = zipfile.ZIP_DEFLATED
+    return info
+
+
+# the lines pyuic4 and pyrcc4 write into the header of the modules they
+# compile that carry the time they ran or the version of the tools
+BANNER_LINE = re.compile(r'#\s*(Created\b|by:)')
+
+
+def strip_banner(data):
+    """ Return the compiled module data without the banner lines in the
+    comments at its top """
+    lines = data.splitlines(True)
+    header = 0
+    while header < len(lines) and (lines[header].startswith('#') or
+                                   not lines[header].strip()):
+        header += 1
+    return ''.join([line for line in lines[:header]
+                    if not BANNER_LINE.match(line)] + lines[header:])
+
+
+def package_files(cfg):
+    """ Return (source, path) for each file and directory a deployment of
+    the plugin contains, path being where it goes in the plugin directory,
+    in the order they are packaged. Files and directories that don't exist
+    are reported and left out, as deploy does. """
+    sources = {}
+    for file in get_install_files(cfg):
+        if os.path.isfile(file):
+            sources[os.path.normpath(file)] = file
         else:
-            click.echo(
-                "Your config file is missing the plugin name (name=parameter)")
+            click.secho("Not packaging {0}: no such file".format(file),
+                        fg='red')
+    trees = [(xdir, xdir) for xdir in cfg.get('files', 'extra_dirs').split()]
+    trees.append((cfg.get('help', 'dir'), cfg.get('help', 'target')))
+    for (src, dest) in trees:
+        if not os.path.isdir(src):
+            click.secho("Not packaging {0}: no such directory".format(src),
+                        fg='red')
+            continue
+        sources[os.path.normpath(dest)] = src
+        for path in tree_files(src, include_dirs=True):
+            sources[os.path.normpath(os.path.join(dest, path))] = \
+                os.path.join(src, path)
+    # every directory holding the files gets its own entry, as with zip -r
+    for (path, src) in sources.items():
+        while os.path.dirname(path):
+            (path, src) = (os.path.dirname(path), os.path.dirname(src))
+            sources.setdefault(path, src or os.curdir)
+    return [(os.curdir, '')] + [(sources[path], path)
+                                for path in sorted(sources)]
 
 
 @cli.command()
@@ -467,30 +2392,19 @@ def validate(config_file):
             fg='green')
     else:
         click.secho("Your {0} file is invalid".format(config_file), fg='red')
-    try:
-        from PyQt5.QtCore import QStandardPaths, QDir
-        path = QStandardPaths.standardLocations(QStandardPaths.AppDataLocation)[0]
-        plugin_path = os.path.join(QDir.homePath(), path, 'QGIS/QGIS3/profiles/default/python/plugins')
-        click.secho("Plugin path: {}".format(plugin_path), fg='green')
-    except:
-        click.secho("""Unable to determine location of your QGIS Plugin directory.
-        Make sure your QGIS environment is setup properly for development and Python
-        has access to the PyQt4.QtCore module.""", fg='red')
-
-    zipbin = find_zip()
-    a7z = find_7z()
-    if zipbin:
-        zip_utility = zipbin
-    elif a7z:
-        zip_utility = a7z
+    profiles = qgis_profiles()
+    if profiles:
+        click.secho("Plugin path: {}".format(
+            get_plugin_directory(qgis_version(cfg))), fg='green')
+        for (version, name, plugin_dir, default) in profiles:
+            click.echo("QGIS {0} profile {1}{2}: {3}".format(
+                version, name, ' (default)' if default else '', plugin_dir))
     else:
-        zip_utility = None
-    if not zip_utility:
-        click.secho('zip or 7z not found. Unable to package the plugin',
+        click.secho("""Unable to find a QGIS profile. Run QGIS once to create
+        one or set QGIS_CUSTOM_CONFIG_PATH if you keep it somewhere else.
+        Plugins will be deployed to {}""".format(
+            get_plugin_directory(qgis_version(cfg))),
                     fg='red')
-        click.secho('Check your path or install a zip program', fg='red')
-    else:
-        click.secho('Found suitable zip utility: {}'.format(zip_utility), fg='green')
     # check for templates - uncomment next 4 after create function is done
     # print(__file__)
     # print("Module: {}".format (sys.modules['pb_tool']))
@@ -630,6 +2544,14 @@ def check_cfg(cfg, section, name):
     return False
 
 
+def get_option(cfg, section, name, default=None):
+    """ Return an optional setting from the config, or default if it is
+    missing or empty """
+    if cfg.has_option(section, name) and cfg.get(section, name).strip():
+        return cfg.get(section, name).strip()
+    return default
+
+
 def get_config(config='pb_tool.cfg'):
     """
     Read the config file pb_tools.cfg and return it
@@ -648,7 +2570,7 @@ def get_config(config='pb_tool.cfg'):
 def compiled_ui(cfg):
     #cfg = get_config(config)
     try:
-        uis = cfg.get('files', 'compiled_ui_files').split()
+        uis = file_list(cfg, 'compiled_ui_files')
         compiled = []
         for ui in uis:
             (base, ext) = os.path.splitext(ui)
@@ -663,11 +2585,14 @@ def compiled_ui(cfg):
 def compiled_resource(cfg):
     #cfg = get_config(config)
     try:
-        res_files = cfg.get('files', 'resource_files').split()
+        res_files = file_list(cfg, 'resource_files')
+        binary = get_option(cfg, 'compile', 'resource_format') == 'rcc'
         compiled = []
         for res in res_files:
             (base, ext) = os.path.splitext(res)
             compiled.append('{0}.py'.format(base))
+            if binary:
+                compiled.append('{0}.rcc'.format(base))
         #print "Compiled resource files: {}".format(compiled)
         return compiled
     except ConfigParser.NoSectionError as oops:
@@ -675,56 +2600,462 @@ def compiled_resource(cfg):
         sys.exit(1)
 
 
-def compile_files(cfg):
-    # Compile all ui and resource files
-    # TODO add changed detection
-    #cfg = get_config(config)
+def compile_files(cfg, jobs=1):
+    """ Compile all ui and resource files, running up to jobs compilers at
+    the same time. Files whose sources and compiler match the fingerprint
+    recorded when they were last built are skipped.
 
+    Returns False if any file failed to compile.
+    """
+    cache = BuildCache()
+    targets = compile_targets(cfg, cache)
+    results = build_targets(cache, targets, jobs)
+    cache.save()
+    for kind in ('UI', 'resource'):
+        built = [target for target in targets if target.kind == kind and
+                 results[target.name] == 'built']
+        print "Compiled {0} {1} files".format(len(built), kind)
+    click.echo(cache.stats())
+    return 'failed' not in results.values()
+
+
+def compile_targets(cfg, cache):
+    """ Return the targets that compile the ui and resource files """
+    targets = []
+    ui_files = file_list(cfg, 'compiled_ui_files')
+
+    # prefer compiling the ui files in this process with PyQt's uic module,
+    # which saves starting pyuic4 (and importing PyQt) once per file
+    uic = uic_version()
     # check to see if we have pyuic4
     pyuic4 = check_path('pyuic4')
 
-    if not pyuic4:
+    if uic:
+        identity = 'PyQt4.uic {0}'.format(uic)
+        targets += source_targets('UI', ui_files, identity, compile_ui)
+    elif not pyuic4:
         print "pyuic4 is not in your path---unable to compile your ui files"
     else:
-        ui_files = cfg.get('files', 'compiled_ui_files').split()
-        ui_count = 0
-        for ui in ui_files:
-            if os.path.exists(ui):
-                (base, ext) = os.path.splitext(ui)
-                output = "{0}.py".format(base)
-                if file_changed(ui, output):
-                    print "Compiling {0} to {1}".format(ui, output)
-                    subprocess.check_call([pyuic4, '-o', output, ui])
-                    ui_count += 1
-                else:
-                    print "Skipping {0} (unchanged)".format(ui)
-            else:
-                print "{0} does not exist---skipped".format(ui)
-        print "Compiled {0} UI files".format(ui_count)
+        targets += source_targets(
+            'UI', ui_files, pyuic4,
+            lambda source, output: subprocess.check_call(
+                [pyuic4, '-o', output, source]))
+
+    # resources are compiled by pyrcc4 if it is available, or by pb_tool's
+    # own resource compiler which needs no Qt tools at all
+    resource_compiler = get_option(cfg, 'compile', 'resource_compiler', 'auto')
+    resource_format = get_option(cfg, 'compile', 'resource_format', 'py')
+    if resource_format == 'rcc':
+        # pyrcc4 can only write Python modules
+        resource_compiler = 'builtin'
+    pyrcc4 = None
+    if resource_compiler != 'builtin':
+        # check to see if we have pyrcc4
+        pyrcc4 = check_path('pyrcc4')
+        if not pyrcc4 and resource_compiler == 'pyrcc4':
+            click.secho(
+                "pyrcc4 is not in your path---unable to compile your resource file(s)",
+                fg='red')
+    res_files = file_list(cfg, 'resource_files')
+    if pyrcc4:
+        targets += source_targets(
+            'resource', res_files, pyrcc4,
+            lambda source, output: subprocess.check_call(
+                [pyrcc4, '-o', output, source]),
+            depends=cache.resource_files)
+    elif resource_compiler != 'pyrcc4':
+        identity = 'pb_tool rcc {0} {1}'.format(__version()[0],
+                                                resource_format)
+        if resource_format == 'rcc':
+            targets += source_targets('resource', res_files, identity,
+                                      compile_binary_resources,
+                                      depends=cache.resource_files,
+                                      extensions=('.rcc', '.py'))
+        else:
+            targets += source_targets('resource', res_files, identity,
+                                      compile_resources,
+                                      depends=cache.resource_files)
+    return targets
 
-    # check to see if we have pyrcc4
-    pyrcc4 = check_path('pyrcc4')
 
-    if not pyrcc4:
-        click.secho(
-            "pyrcc4 is not in your path---unable to compile your resource file(s)",
-            fg='red')
-    else:
-        res_files = cfg.get('files', 'resource_files').split()
-        res_count = 0
-        for res in res_files:
-            if os.path.exists(res):
-                (base, ext) = os.path.splitext(res)
-                output = "{0}.py".format(base)
-                if file_changed(res, output):
-                    print "Compiling {0} to {1}".format(res, output)
-                    subprocess.check_call([pyrcc4, '-o', output, res])
-                    res_count += 1
-                else:
-                    print "Skipping {0} (unchanged)".format(res)
+def source_targets(kind, sources, identity, compile_source, depends=None,
+                   extensions=('.py',)):
+    """ Return a Target for each of sources that exists.
+
+    compile_source(source, output) builds the output, which is named after
+    the source with its extension replaced by the first of extensions; the
+    others name any further files it writes. depends, if given, returns
+    the other files a source pulls in when it is compiled.
+    """
+    targets = []
+    for source in sources:
+        if os.path.exists(source):
+            (base, ext) = os.path.splitext(source)
+            outputs = [base + extension for extension in extensions]
+            inputs = [source]
+            if depends:
+                inputs += depends(source)
+            targets.append(Target(
+                outputs[0], kind, inputs, outputs,
+                lambda target, source=source: compile_source(
+                    source, target.name),
+                identity=identity, label=source,
+                message="Compiled {0} to {1}".format(source, outputs[0])))
+        else:
+            print "{0} does not exist---skipped".format(source)
+    return targets
+
+
+def uic_version():
+    """ Return the PyQt4 version if ui files can be compiled in this process
+    using its uic module, or None if they have to be compiled with pyuic4 """
+    try:
+        from PyQt4 import uic
+        from PyQt4.QtCore import PYQT_VERSION_STR
+    except ImportError:
+        return None
+    return PYQT_VERSION_STR
+
+
+# uic isn't thread safe, so in-process compiles are done one at a time
+uic_lock = threading.Lock()
+
+
+def compile_ui(source, output):
+    """ Compile a ui file to Python the same way pyuic4 does """
+    from PyQt4 import uic
+    with uic_lock:
+        with open(source) as ui, open(output, 'w') as py:
+            uic.compileUi(ui, py)
+
+
+def run_jobs(func, items, jobs=1):
+    """ Call func on each of items using a pool of up to jobs threads and
+    yield the results in the order of items.
+
+    Closing the generator early stops any items that have not been started
+    yet; items already running are allowed to finish.
+    """
+    if jobs <= 1 or len(items) <= 1:
+        for item in items:
+            yield func(item)
+        return
+    pool = ThreadPool(min(jobs, len(items)))
+    try:
+        for result in pool.imap(func, items):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def parse_qrc(qrc, strict=False):
+    """ Return [resource path, file] for each <file> listed in a qrc file.
+
+    The resource path includes the qresource prefix and honours any alias.
+    The file path is relative to the current directory, or empty for an
+    empty <file>. A file that can't be read or parsed has no entries,
+    which is enough to track what depends on it; with strict the error is
+    raised instead, as the resource compilers need.
+    """
+    base = os.path.dirname(qrc)
+    entries = []
+    try:
+        root = ElementTree.parse(qrc).getroot()
+    except (ElementTree.ParseError, IOError):
+        if strict:
+            raise
+        return entries
+    for resource in root.findall('qresource'):
+        prefix = resource.get('prefix', '').strip('/')
+        for item in resource.findall('file'):
+            name = (item.text or '').strip()
+            alias = item.get('alias', name).strip('/')
+            path = os.path.normpath(os.path.join(base, name)) if name else ''
+            entries.append(['/'.join(part for part in (prefix, alias) if part),
+                            path])
+    return entries
+
+
+RCC_COMPRESSED = 0x01
+RCC_DIRECTORY = 0x02
+# an asset is stored compressed if that saves at least this percentage of
+# its size, the same threshold rcc uses
+RCC_COMPRESS_THRESHOLD = 70
+# compressed assets larger than this are spooled to disk while compiling
+RCC_SPOOL_SIZE = 1024 * 1024
+RCC_CHUNK_SIZE = 65536
+
+RESOURCE_MODULE_HEADER = """# -*- coding: utf-8 -*-
+
+# Resource object code
+#
+# Created by: the pb_tool resource compiler
+#
+# WARNING! All changes made in this file will be lost!
+
+from PyQt4 import QtCore
+
+"""
+
+RESOURCE_MODULE_FOOTER = """def qInitResources():
+    QtCore.qRegisterResourceData(0x01, qt_resource_struct, qt_resource_name, qt_resource_data)
+
+def qCleanupResources():
+    QtCore.qUnregisterResourceData(0x01, qt_resource_struct, qt_resource_name, qt_resource_data)
+
+qInitResources()
+"""
+
+
+def compile_resources(qrc, output):
+    """ Compile a qrc file into a Python resource module equivalent to the
+    one pyrcc4 writes, without starting pyrcc4.
+
+    Assets are compressed and written to the module one at a time, in
+    chunks, so the resource set is never held in memory as a whole.
+    """
+    root = resource_tree(parse_qrc(qrc, strict=True))
+    with open(output, 'w') as py:
+        py.write(RESOURCE_MODULE_HEADER)
+        for (name, writer) in (('qt_resource_data', write_resource_data),
+                               ('qt_resource_name', write_resource_names),
+                               ('qt_resource_struct', write_resource_struct)):
+            py.write('{0} = b"\\\n'.format(name))
+            literal = ByteLiteral(py)
+            writer(root, literal.write)
+            literal.close()
+            py.write('"\n\n')
+        py.write(RESOURCE_MODULE_FOOTER)
+
+
+RESOURCE_LOADER = """# -*- coding: utf-8 -*-
+
+# Resource loader for {0}
+#
+# Created by: the pb_tool resource compiler
+#
+# WARNING! All changes made in this file will be lost!
+
+import os
+
+from PyQt4 import QtCore
+
+rcc_file = os.path.join(os.path.dirname(__file__), '{0}')
+
+def qInitResources():
+    QtCore.QResource.registerResource(rcc_file)
+
+def qCleanupResources():
+    QtCore.QResource.unregisterResource(rcc_file)
+
+qInitResources()
+"""
+
+
+def compile_binary_resources(qrc, output):
+    """ Compile a qrc file to a binary .rcc file, which Qt memory maps
+    rather than having Python unmarshal the assets, and write a small
+    Python module next to it that registers it in place of the usual
+    resource module.
+    """
+    root = resource_tree(parse_qrc(qrc, strict=True))
+    with open(output, 'wb') as rcc:
+        # magic, format version, then the tree, data and names offsets,
+        # which are filled in once the sections have been written
+        rcc.write(b'qres' + struct.pack('>IIII', 1, 0, 0, 0))
+        offsets = []
+        for writer in (write_resource_data, write_resource_names,
+                       write_resource_struct):
+            offsets.append(rcc.tell())
+            writer(root, rcc.write)
+        rcc.seek(8)
+        rcc.write(struct.pack('>III', offsets[2], offsets[0], offsets[1]))
+    (base, ext) = os.path.splitext(output)
+    with open('{0}.py'.format(base), 'w') as py:
+        py.write(RESOURCE_LOADER.format(os.path.basename(output)))
+
+
+class ByteLiteral(object):
+    """ Write bytes to a Python source file as the body of a bytes literal,
+    sixteen escaped bytes per line """
+
+    ESCAPES = ['\\x{0:02x}'.format(byte) for byte in range(256)]
+
+    def __init__(self, out):
+        self.out = out
+        self.pending = bytearray()
+
+    def write(self, data):
+        self.pending.extend(data)
+        lines = len(self.pending) // 16 * 16
+        for start in range(0, lines, 16):
+            self._write_line(self.pending[start:start + 16])
+        del self.pending[:lines]
+
+    def close(self):
+        if self.pending:
+            self._write_line(self.pending)
+        del self.pending[:]
+
+    def _write_line(self, chunk):
+        self.out.write(''.join(map(self.ESCAPES.__getitem__, chunk)))
+        self.out.write('\\\n')
+
+
+def resource_tree(entries):
+    """ Build the tree of resource nodes for the entries of a qrc file.
+
+    Directories are dicts with name and children; files are dicts with
+    name and the path of the asset.
+    """
+    root = {'name': u'', 'children': {}}
+    for (alias, path) in entries:
+        if not path:
+            raise ValueError("empty <file> element for resource '{0}'".format(
+                alias))
+        if os.path.isdir(path):
+            for (dirpath, dirs, names) in os.walk(path):
+                rel = os.path.relpath(dirpath, path).replace(os.sep, '/')
+                for name in names:
+                    add_resource(root, '/'.join(
+                        part for part in (alias, rel, name)
+                        if part and part != '.'), os.path.join(dirpath, name))
+        else:
+            add_resource(root, alias, path)
+    return root
+
+
+def add_resource(root, alias, path):
+    if isinstance(alias, bytes):
+        alias = alias.decode('utf-8')
+    parts = [part for part in alias.split('/') if part]
+    if not parts:
+        raise ValueError("empty alias for resource file '{0}'".format(path))
+    node = root
+    for part in parts[:-1]:
+        node = node['children'].setdefault(part,
+                                           {'name': part, 'children': {}})
+    node['children'][parts[-1]] = {'name': parts[-1], 'path': path}
+
+
+def resource_nodes(node):
+    """ Yield every node below node, depth first in name order """
+    for name in sorted(node['children']):
+        child = node['children'][name]
+        yield child
+        if 'children' in child:
+            for descendant in resource_nodes(child):
+                yield descendant
+
+
+def rcc_hash(name):
+    """ Return the hash Qt uses to look up a resource name """
+    units = name.encode('utf-16-be')
+    h = 0
+    for unit in struct.unpack('>{0}H'.format(len(units) // 2), units):
+        h = (h << 4) + unit
+        h ^= (h & 0xf0000000) >> 23
+        h &= 0x0fffffff
+    return h
+
+
+def write_resource_data(root, write):
+    """ Write the payload of every asset, recording each file node's data
+    offset and flags """
+    offset = 0
+    for node in resource_nodes(root):
+        if 'path' not in node:
+            continue
+        node['offset'] = offset
+        node['flags'] = 0
+        size = os.path.getsize(node['path'])
+        with open(node['path'], 'rb') as asset:
+            payload = compress_asset(asset, size)
+            if payload:
+                node['flags'] |= RCC_COMPRESSED
+                length = payload.tell()
+                payload.seek(0)
             else:
-                print "{0} does not exist---skipped".format(res)
-        print "Compiled {0} resource files".format(res_count)
+                payload = asset
+                payload.seek(0)
+                length = size
+            write(struct.pack('>I', length))
+            for chunk in iter(lambda: payload.read(RCC_CHUNK_SIZE), b''):
+                write(chunk)
+            payload.close()
+        offset += 4 + length
+
+
+def compress_asset(asset, size):
+    """ Return a file holding the asset compressed the way qCompress does,
+    or None if compressing it isn't worthwhile """
+    if not size:
+        return None
+    payload = tempfile.SpooledTemporaryFile(max_size=RCC_SPOOL_SIZE)
+    payload.write(struct.pack('>I', size))
+    compressor = zlib.compressobj()
+    for chunk in iter(lambda: asset.read(RCC_CHUNK_SIZE), b''):
+        payload.write(compressor.compress(chunk))
+    payload.write(compressor.flush())
+    if int(100.0 * (size - payload.tell()) / size) < RCC_COMPRESS_THRESHOLD:
+        payload.close()
+        return None
+    return payload
+
+
+def write_resource_names(root, write):
+    """ Write the name table, recording each node's name offset """
+    offsets = {}
+    offset = 0
+    for node in resource_nodes(root):
+        name = node['name']
+        if name not in offsets:
+            offsets[name] = offset
+            units = name.encode('utf-16-be')
+            write(struct.pack('>HI', len(units) // 2, rcc_hash(name)))
+            write(units)
+            offset += 6 + len(units)
+        node['name_offset'] = offsets[name]
+
+
+def write_resource_struct(root, write):
+    """ Write the tree structure. The children of a directory are stored
+    next to each other, sorted by name hash so Qt can binary search them.
+    """
+    def children(node):
+        return sorted(node['children'].values(),
+                      key=lambda child: (rcc_hash(child['name']),
+                                         child['name']))
+
+    def info(node):
+        if 'children' in node:
+            return struct.pack('>IHII', node.get('name_offset', 0),
+                               RCC_DIRECTORY, len(node['children']),
+                               node['child_offset'])
+        # country AnyCountry (0), language C (1)
+        return struct.pack('>IHHHI', node['name_offset'], node['flags'],
+                           0, 1, node['offset'])
+
+    # number the nodes in the order they are written, root first
+    pending = [root]
+    index = 1
+    while pending:
+        node = pending.pop()
+        node['child_offset'] = index
+        for child in children(node):
+            index += 1
+            if 'children' in child:
+                pending.append(child)
+
+    write(info(root))
+    pending = [root]
+    while pending:
+        node = pending.pop()
+        for child in children(node):
+            write(info(child))
+            if 'children' in child:
+                pending.append(child)
 
 
 def copy(source, destination):
@@ -741,8 +3072,7 @@ def copy(source, destination):
 
     """
     try:
-        #shutil.copytree(source, destination)
-        copy_tree(source, destination)
+        copy_dir(source, destination)
     except OSError as e:
         # If the error was caused because the source wasn't a directory
         if e.errno == errno.ENOTDIR:
@@ -751,10 +3081,133 @@ def copy(source, destination):
             print('Directory not copied. Error: %s' % e)
 
 
-def get_plugin_directory():
-    home = os.path.expanduser('~')
-    qgis2 = os.path.join('.qgis2', 'python', 'plugins')
-    return os.path.join(home, qgis2)
+def get_plugin_directory(version=2):
+    """ Return the plugin directory of QGIS version: that of the default
+    profile for QGIS 3, or of the .qgis2 configuration for QGIS 2. If QGIS
+    hasn't been run yet, this is where it will create it. """
+    profiles = qgis_profiles()
+    found = [plugin_dir for (qgis, name, plugin_dir, default) in profiles
+             if qgis == version]
+    defaults = [plugin_dir for (qgis, name, plugin_dir, default) in profiles
+                if qgis == version and default]
+    if defaults or found:
+        return (defaults or found)[0]
+    if version == 3:
+        return os.path.join(qgis3_profiles_root(), 'default', 'python',
+                            'plugins')
+    return os.path.join(qgis2_config_dir(), 'python', 'plugins')
+
+
+def qgis_version(cfg):
+    """ Return the QGIS version whose plugin directory is deployed to when
+    no plugin_path is given: the qgis_version setting of the config, or 2
+    """
+    version = get_option(cfg, 'plugin', 'qgis_version', '2').strip()
+    if version not in ('2', '3'):
+        raise click.UsageError(
+            "qgis_version must be 2 or 3, not {0}".format(version))
+    return int(version)
+
+
+# environment variables that decide where QGIS keeps its profiles
+PROFILE_ENVIRONMENT = ('QGIS_CUSTOM_CONFIG_PATH', 'XDG_DATA_HOME', 'APPDATA',
+                       'HOME', 'USERPROFILE')
+
+
+def qgis3_profiles_root():
+    """ Return the directory QGIS 3 keeps its user profiles in, worked out
+    the way QGIS does without asking Qt """
+    custom = os.environ.get('QGIS_CUSTOM_CONFIG_PATH')
+    if custom:
+        base = custom
+    elif sys.platform == 'win32':
+        base = os.path.join(
+            os.environ.get('APPDATA', os.path.expanduser('~')), 'QGIS',
+            'QGIS3')
+    elif sys.platform == 'darwin':
+        base = os.path.join(os.path.expanduser('~'), 'Library',
+                            'Application Support', 'QGIS', 'QGIS3')
+    else:
+        data = (os.environ.get('XDG_DATA_HOME') or
+                os.path.join(os.path.expanduser('~'), '.local', 'share'))
+        base = os.path.join(data, 'QGIS', 'QGIS3')
+    return os.path.join(base, 'profiles')
+
+
+def qgis2_config_dir():
+    """ Return the QGIS 2 configuration directory """
+    return (os.environ.get('QGIS_CUSTOM_CONFIG_PATH') or
+            os.path.join(os.path.expanduser('~'), '.qgis2'))
+
+
+def discover_profiles():
+    """ Return [QGIS version, profile name, plugin directory, whether it is
+    the default profile] for every QGIS 3 profile and QGIS 2 configuration
+    found. Only the filesystem is looked at. """
+    profiles = []
+    root = qgis3_profiles_root()
+    if os.path.isdir(root):
+        parser = ConfigParser.RawConfigParser()
+        parser.read(os.path.join(root, 'profiles.ini'))
+        try:
+            default = parser.get('core', 'defaultProfile')
+        except ConfigParser.Error:
+            default = 'default'
+        for name in sorted(os.listdir(root)):
+            if os.path.isdir(os.path.join(root, name)):
+                profiles.append([3, name,
+                                 os.path.join(root, name, 'python', 'plugins'),
+                                 name == default])
+    qgis2 = qgis2_config_dir()
+    if os.path.isdir(qgis2):
+        profiles.append([2, 'default', os.path.join(qgis2, 'python', 'plugins'),
+                         True])
+    return profiles
+
+
+def qgis_profiles():
+    """ Return discover_profiles(), cached until the environment or the
+    directories QGIS keeps its profiles in change """
+    global _profiles
+    root = qgis3_profiles_root()
+    key = ([sys.platform] +
+           [os.environ.get(name) for name in PROFILE_ENVIRONMENT] +
+           [stat_key(path) for path in (root,
+                                        os.path.join(root, 'profiles.ini'),
+                                        qgis2_config_dir())])
+    # json has no tuples, so compare the key the way it is stored
+    key = json.loads(json.dumps(key))
+    if _profiles and _profiles[0] == key:
+        return _profiles[1]
+    cache_file = profiles_cache_file()
+    try:
+        with open(cache_file) as f:
+            cached = json.load(f)
+        if cached.get('key') == key:
+            _profiles = (key, cached['profiles'])
+            return _profiles[1]
+    except (IOError, ValueError, KeyError, AttributeError):
+        pass
+    profiles = discover_profiles()
+    _profiles = (key, profiles)
+    try:
+        if not os.path.isdir(os.path.dirname(cache_file)):
+            os.makedirs(os.path.dirname(cache_file))
+        with open(cache_file, 'w') as f:
+            json.dump({'key': key, 'profiles': profiles}, f)
+    except EnvironmentError:
+        # it is only a cache
+        pass
+    return profiles
+
+
+_profiles = None
+
+
+def profiles_cache_file():
+    cache = (os.environ.get('XDG_CACHE_HOME') or
+             os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache, 'pb_tool', 'profiles.json')
 
 
 def config_template():
@@ -775,9 +3228,14 @@ name: $Name
 
 # Full path to where you want your plugin directory copied. If empty,
 # the QGIS default path will be used. Don't include the plugin name in
-# the path.
+# the path. List several paths, separated by : (; on Windows) or on
+# lines of their own, to deploy to all of them at once.
 plugin_path:
 
+# QGIS version whose plugin directory is used when plugin_path is empty:
+# 2 for .qgis2/python/plugins, or 3 for the default QGIS 3 profile.
+qgis_version: 2
+
 [files]
 # Python  files that should be deployed with the plugin
 python_files: $PythonFiles
@@ -802,6 +3260,18 @@ extra_dirs:
 # Corresponding .ts files must exist in the i18n directory
 locales: $Locales
 
+[compile]
+# Compiler used for the resource files: pyrcc4, builtin (the compiler
+# built into pb_tool, which doesn't need the Qt tools) or auto (pyrcc4 if
+# it is in your path, otherwise builtin)
+resource_compiler: auto
+
+# Format of the compiled resources: py (a Python module with the assets
+# embedded in it) or rcc (a binary .rcc file, memory mapped by Qt, and a
+# small Python module that registers it). rcc always uses the builtin
+# compiler.
+resource_format: py
+
 [help]
 # the built help directory that should be deployed with the plugin
 dir: help/build/html
@@ -840,22 +3310,263 @@ def check_path(app):
     return None
 
 
-def file_changed(infile, outfile):
+class Target(object):
+    """ Something pb_tool builds: a compiled ui or resource file, a .qm
+    translation, the HTML help, the deployed plugin or its zip package.
+
+    name identifies the target and keys its fingerprint in the BuildCache.
+    The fingerprint combines the contents of inputs (files or directories)
+    with identity, naming the tool that builds the target. deps are the
+    names of the targets that must be up to date before this one is
+    built. action is called with the target to build outputs and raises
+    if it can't. Targets that aren't cached are built every time.
+    """
+
+    def __init__(self, name, kind, inputs, outputs, action, identity='',
+                 deps=(), label=None, message=None, cached=True):
+        self.name = name
+        self.kind = kind
+        self.inputs = inputs
+        self.outputs = outputs
+        self.action = action
+        self.identity = identity
+        self.deps = deps
+        # shown when the target is skipped and after it is built
+        self.label = label or name
+        if message is None:
+            message = "Built {0}".format(self.label)
+        self.message = message
+        self.cached = cached
+
+
+def build_targets(cache, targets, jobs=1, keep_going=False):
+    """ Bring targets up to date, running the actions of targets that don't
+    depend on each other on up to jobs threads at the same time.
+
+    A target is started once the targets it depends on are up to date and
+    is skipped if its fingerprint shows it already is. Dependencies on
+    targets that aren't in targets are ignored. After a failure no new
+    targets are started unless keep_going is set, in which case only the
+    targets that depend on the failed one are left out. Returns a dict of
+    the result for each target name: 'built', 'skipped', 'failed' or
+    'not built'.
+    """
+    names = set(target.name for target in targets)
+    waiting = [target for target in targets]
+    results = {}
+    fingerprints = {}
+    finished = Queue.Queue()
+    running = 0
+    failed = False
+    pool = ThreadPool(jobs)
     try:
-        infile_s = os.stat(infile)
-        outfile_s = os.stat(outfile)
-        return infile_s.st_mtime > outfile_s.st_mtime
-    except:
-        return True
+        while True:
+            ready = None
+            while (keep_going or not failed) and ready != []:
+                ready = [target for target in waiting if all(
+                    results.get(dep) in ('built', 'skipped')
+                    for dep in target.deps if dep in names)]
+                for target in ready:
+                    waiting.remove(target)
+                    fingerprint = None
+                    if target.cached:
+                        fingerprint = cache.fingerprint(target.inputs,
+                                                        target.identity)
+                    if target.cached and cache.is_current(
+                            target.name, fingerprint, target.outputs):
+                        print "Skipping {0} (unchanged)".format(target.label)
+                        results[target.name] = 'skipped'
+                    else:
+                        fingerprints[target.name] = fingerprint
+                        pool.apply_async(run_target, (target,),
+                                         callback=finished.put)
+                        running += 1
+                # targets that were skipped may have made others ready
+                ready = [target for target in ready
+                         if results.get(target.name) == 'skipped']
+            if not running:
+                break
+            (target, error) = wait_for(finished)
+            running -= 1
+            if error:
+                click.secho(error, fg='red')
+                results[target.name] = 'failed'
+                failed = True
+            else:
+                if target.message:
+                    print target.message
+                if target.cached:
+                    cache.record(target.name, fingerprints[target.name])
+                results[target.name] = 'built'
+    finally:
+        pool.close()
+        pool.join()
+    for target in waiting:
+        results[target.name] = 'not built'
+    return results
+
+
+def run_target(target):
+    """ Run the action of a target and return (target, error message) """
+    try:
+        target.action(target)
+    except Exception as oops:
+        return (target, "Building {0} failed: {1}".format(target.label,
+                                                           oops))
+    return (target, None)
+
+
+def wait_for(queue):
+    """ Return the next item from queue, waiting in short steps so Ctrl-C
+    still works while a build is running """
+    while True:
+        try:
+            return queue.get(True, 0.5)
+        except Queue.Empty:
+            pass
+
+
+CACHE_DIR = '.pb_tool'
+CACHE_VERSION = 2
+# flag each compiler uses to report its version (default is --version)
+VERSION_FLAGS = {'pyrcc4': '-version', 'lrelease': '-version',
+                 'lrelease-qt4': '-version'}
 
 
-def find_zip():
-    # check to see if we can find zip
-    zip = check_path('zip')
-    return zip
+class BuildCache(object):
+    """Persistent fingerprint store used to skip up to date build steps.
+
+    The cache lives in the .pb_tool directory of the plugin source tree.
+    Content hashes are remembered along with the size, mtime, inode and
+    ctime of the file they were computed from, so a file is only read again
+    when its stat changes. A fingerprint combines the content hashes of an output's
+    sources with the identity of the tool that builds it; the output is
+    rebuilt whenever its fingerprint differs from the one recorded when it
+    was last built.
+    """
+
+    def __init__(self, directory=CACHE_DIR):
+        self.directory = directory
+        self.path = os.path.join(directory, 'cache.json')
+        self.hits = 0
+        self.misses = 0
+        self.data = {'hashes': {}, 'fingerprints': {}, 'tools': {},
+                     'resources': {}, 'messages': {}}
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            if data.get('version') == CACHE_VERSION:
+                for table in self.data:
+                    self.data[table].update(data.get(table, {}))
+        except (IOError, ValueError):
+            # a missing or corrupt cache just means everything is rebuilt
+            pass
+
+    def file_hash(self, path):
+        """ Return the sha1 of the contents of path """
+        st = os.stat(path)
+        # a checkout or restore can give a changed file the same size and
+        # mtime, but writing it always moves its ctime or inode
+        key = [st.st_size, st.st_mtime, st.st_ino, st.st_ctime]
+        known = self.data['hashes'].get(path)
+        if known and known[:4] == key:
+            return known[4]
+        digest = file_sha1(path)
+        self.data['hashes'][path] = key + [digest]
+        return digest
+
+    def tool_version(self, binary):
+        """ Return the version banner reported by a compiler binary.
+
+        The banner is only queried again when the binary itself changes.
+        """
+        try:
+            st = os.stat(binary)
+        except OSError:
+            return ''
+        known = self.data['tools'].get(binary)
+        if known and known[0] == st.st_size and known[1] == st.st_mtime:
+            return known[2]
+        try:
+            name = os.path.splitext(os.path.basename(binary))[0]
+            flag = VERSION_FLAGS.get(name, '--version')
+            proc = subprocess.Popen([binary, flag],
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT)
+            banner = proc.communicate()[0].decode('utf-8', 'replace').strip()
+        except OSError:
+            banner = ''
+        self.data['tools'][binary] = [st.st_size, st.st_mtime, banner]
+        return banner
+
+    def fingerprint(self, sources, tool):
+        """ Return the fingerprint of sources built with tool """
+        sha = hashlib.sha1()
+        sha.update(tool.encode('utf-8'))
+        sha.update(self.tool_version(tool).encode('utf-8'))
+        for source in sources:
+            if os.path.isdir(source):
+                for (root, dirs, names) in os.walk(source):
+                    dirs.sort()
+                    for name in sorted(names):
+                        path = os.path.join(root, name)
+                        sha.update(path.encode('utf-8'))
+                        sha.update(self.file_hash(path).encode('utf-8'))
+                continue
+            sha.update(source.encode('utf-8'))
+            if os.path.exists(source):
+                sha.update(self.file_hash(source).encode('utf-8'))
+        return sha.hexdigest()
+
+    def parsed(self, table, path, parse):
+        """ Return parse(path), calling parse again only when the contents
+        of path have changed since its result was stored in table """
+        digest = self.file_hash(path)
+        known = self.data[table].get(path)
+        if known and known[0] == digest:
+            return known[1]
+        result = parse(path)
+        self.data[table][path] = [digest, result]
+        return result
+
+    def resource_entries(self, qrc):
+        """ Return parse_qrc(qrc), parsing the file again only when its
+        contents have changed """
+        return self.parsed('resources', qrc, parse_qrc)
+
+    def resource_files(self, qrc):
+        """ Return the asset files a qrc file compiles into its resource
+        module, expanding any directory entries """
+        files = []
+        for (alias, path) in self.resource_entries(qrc):
+            if os.path.isdir(path):
+                for (root, dirs, names) in os.walk(path):
+                    dirs.sort()
+                    files += [os.path.join(root, name) for name in sorted(names)]
+            elif path:
+                files.append(path)
+        return files
+
+    def is_current(self, name, fingerprint, outputs):
+        """ Return True if outputs exist and were last built from
+        fingerprint """
+        current = (all(os.path.exists(output) for output in outputs) and
+                   self.data['fingerprints'].get(name) == fingerprint)
+        if current:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return current
+
+    def record(self, name, fingerprint):
+        self.data['fingerprints'][name] = fingerprint
 
+    def save(self):
+        make_dirs(self.directory)
+        data = dict(self.data, version=CACHE_VERSION)
+        with open(self.path, 'w') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
 
-def find_7z():
-    # check for 7z
-    zip = check_path('7z')
-    return zip
+    def stats(self):
+        return "Build cache: {0} up to date, {1} out of date".format(
+            self.hits, self.misses)
@@ -47,7 +47,8 @@ setup(
     install_requires=[
         'Click', 
         'Sphinx',
-        'colorama'
+        'colorama',
+        'scandir; python_version < "3.5"'
     ],
     entry_points='''
         [console_scripts]
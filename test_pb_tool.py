@@ -1,4 +1,7 @@
 import os
+import sys
+import ConfigParser
+import warnings
 
 import click
 from click.testing import CliRunner
@@ -7,6 +10,20 @@ from pb_tool import pb_tool
 runner = CliRunner()
 
 
+def plugin_config(help_dir='help/build/html', **files):
+    """ Return the config of a plugin whose [files] are all empty except
+    those given, with its help built in help_dir """
+    cfg = ConfigParser.ConfigParser()
+    cfg.add_section('files')
+    for option in ['python_files', 'main_dialog', 'compiled_ui_files',
+                   'resource_files', 'extras', 'extra_dirs']:
+        cfg.set('files', option, files.get(option, ''))
+    cfg.add_section('help')
+    cfg.set('help', 'dir', help_dir)
+    cfg.set('help', 'target', 'help')
+    return cfg
+
+
 def test_validate():
     result = runner.invoke(pb_tool.cli, ['validate'])
     assert result.exit_code == 0
@@ -51,11 +68,44 @@ def test_zip():
     #assert os.path.exists(os.path.join(os.getcwd(), 'whereami.zip'))
 
 
+def test_zip_failed_build(monkeypatch):
+    def fail(target):
+        raise RuntimeError('no compiler')
+    monkeypatch.setattr(pb_tool, 'compile_targets', lambda cfg, cache: [
+        pb_tool.Target('broken.py', 'UI', [], ['broken.py'], fail)])
+    result = runner.invoke(pb_tool.cli, ['zip'])
+    assert result.exit_code == 1
+    assert 'Building broken.py failed: no compiler' in result.output
+
+
+def test_deploy_failed_build(tmpdir, monkeypatch):
+    def fail(target):
+        raise RuntimeError('no sphinx')
+    monkeypatch.setattr(pb_tool, 'docs_targets', lambda jobs=1: [
+        pb_tool.Target('help', 'docs', [], ['help'], fail)])
+    assert runner.invoke(pb_tool.cli, ['doc']).exit_code == 1
+    for args in ([], ['--sync']):
+        result = runner.invoke(pb_tool.cli, ['deploy', '-y', '-p',
+                                             str(tmpdir)] + args)
+        assert result.exit_code == 1
+
+
 def test_dclean():
     result = runner.invoke(pb_tool.cli, ['dclean'], input='y\n')
     assert result.exit_code == 0
 
 
+def test_dclean_plugin_path(tmpdir):
+    for path in ('one', 'two'):
+        tmpdir.ensure(path, 'TestPlugin', 'plugin.py')
+    result = runner.invoke(pb_tool.cli, [
+        'dclean', '-p', str(tmpdir.join('one')), '-p',
+        str(tmpdir.join('two'))], input='y\ny\n')
+    assert result.exit_code == 0
+    assert not tmpdir.join('one', 'TestPlugin').check()
+    assert not tmpdir.join('two', 'TestPlugin').check()
+
+
 # def test_help():
 #     result = runner.invoke(pb_tool.cli, ['help'])
 #     assert result.exit_code == 0
@@ -81,6 +131,583 @@ def test_version():
 def test_compile():
     result = runner.invoke(pb_tool.cli, ['compile'])
     assert result.exit_code == 0
+    assert 'Build cache' in result.output
+
+
+def test_compile_jobs():
+    result = runner.invoke(pb_tool.cli, ['compile', '--jobs', '2'])
+    assert result.exit_code == 0
+
+
+def test_translate():
+    result = runner.invoke(pb_tool.cli, ['translate', '--jobs', '2'])
+    assert result.exit_code == 0
+
+
+def test_parse_qrc():
+    entries = pb_tool.parse_qrc('resources.qrc')
+    assert entries == [['plugins/TestPlugin/icon.png', 'icon.png']]
+
+
+def test_compile_resources(tmpdir):
+    tmpdir.join('icon.png').write('not really a png' * 100)
+    qrc = tmpdir.join('resources.qrc')
+    qrc.write('<RCC><qresource prefix="/plugins/test">'
+              '<file>icon.png</file></qresource></RCC>')
+    output = tmpdir.join('resources.py')
+    pb_tool.compile_resources(str(qrc), str(output))
+    source = output.read()
+    compile(source, str(output), 'exec')
+    assert 'qInitResources()' in source
+
+
+def test_compile_empty_resource(tmpdir):
+    tmpdir.join('icon.png').write('png')
+    qrc = tmpdir.join('resources.qrc')
+    output = str(tmpdir.join('resources.py'))
+    for (entry, error) in [
+            ('<file></file>', "empty <file> element for resource ''"),
+            ('<file alias="/">icon.png</file>',
+             "empty alias for resource file '{0}'".format(
+                 tmpdir.join('icon.png')))]:
+        qrc.write('<RCC><qresource>{0}</qresource></RCC>'.format(entry))
+        try:
+            pb_tool.compile_resources(str(qrc), output)
+        except ValueError as oops:
+            assert str(oops) == error
+        else:
+            assert False, entry
+
+
+def test_compile_broken_resource(tmpdir):
+    qrc = tmpdir.join('resources.qrc')
+    output = str(tmpdir.join('resources.py'))
+    for contents in ('<RCC><qresource>', None):
+        if contents is None:
+            qrc.remove()
+        else:
+            qrc.write(contents)
+        # dependency tracking carries on without the entries
+        assert pb_tool.parse_qrc(str(qrc)) == []
+        for compiler in (pb_tool.compile_resources,
+                         pb_tool.compile_binary_resources):
+            try:
+                compiler(str(qrc), output)
+            except (pb_tool.ElementTree.ParseError, IOError):
+                pass
+            else:
+                assert False, contents
+
+
+def test_compile_binary_resources(tmpdir):
+    tmpdir.join('icon.png').write('not really a png' * 100)
+    qrc = tmpdir.join('resources.qrc')
+    qrc.write('<RCC><qresource prefix="/plugins/test">'
+              '<file>icon.png</file></qresource></RCC>')
+    pb_tool.compile_binary_resources(str(qrc),
+                                     str(tmpdir.join('resources.rcc')))
+    assert tmpdir.join('resources.rcc').read('rb')[:4] == b'qres'
+    assert 'registerResource' in tmpdir.join('resources.py').read()
+
+
+def test_build_sphinx(tmpdir):
+    source = tmpdir.ensure('help', 'source', dir=True)
+    source.join('conf.py').write("master_doc = 'index'\n")
+    source.join('index.rst').write('Help\n====\n')
+    cwd = os.getcwd()
+    pb_tool.build_sphinx(str(tmpdir.join('help')), jobs=2)
+    assert os.getcwd() == cwd
+    assert tmpdir.join('help', 'build', 'html', 'index.html').check()
+    assert tmpdir.join('help', 'build', 'doctrees').check(dir=1)
+
+
+def test_polling_watcher(tmpdir):
+    source = tmpdir.join('plugin.py')
+    source.write('')
+    tmpdir.mkdir('data')
+    watcher = pb_tool.PollingWatcher([str(source)], [str(tmpdir.join('data'))],
+                                     interval=0.1)
+    assert watcher.wait(0.2) == set()
+    source.write('import os')
+    tmpdir.join('data', 'new.csv').write('x')
+    assert watcher.wait(1) == set([str(source),
+                                   str(tmpdir.join('data', 'new.csv'))])
+
+
+def test_inotify_watcher_close(tmpdir):
+    watcher = pb_tool.InotifyWatcher([], [str(tmpdir)])
+    fd = watcher.fd
+    watcher.close()
+    try:
+        os.fstat(fd)
+    except OSError:
+        pass
+    else:
+        assert False, 'the inotify descriptor is still open'
+
+
+def test_redeploy_changes(tmpdir, monkeypatch):
+    source = tmpdir.mkdir('source')
+    source.join('plugin.py').write('print 1')
+    source.ensure('scripts', 'run.sh')
+    source.ensure('help', 'source', 'index.rst')
+    cfg = plugin_config(python_files='plugin.py', extra_dirs='scripts')
+
+    def fail():
+        raise pb_tool.subprocess.CalledProcessError(2, 'sphinx')
+    monkeypatch.setattr(pb_tool, 'build_docs', fail)
+    plugin_dir = tmpdir.join('Test')
+    with source.as_cwd():
+        linker = pb_tool.Installer(str(plugin_dir), link_mode='symlink')
+        linker.install_dir('scripts', 'scripts', 'scripts',
+                           'Error copying directory')
+        copier = pb_tool.Installer(str(plugin_dir))
+        copier.install_file('plugin.py')
+        pb_tool.write_manifest(str(plugin_dir),
+                               linker.installed | copier.installed)
+        source.join('plugin.py').write('print 2')
+        source.join('scripts', 'run.sh').write('echo')
+        pb_tool.redeploy_changes(cfg, [str(plugin_dir)], set([
+            'plugin.py', os.path.join('scripts', 'run.sh'),
+            os.path.join('help', 'source', 'index.rst')]))
+    assert source.join('scripts', 'run.sh').read() == 'echo'
+    assert plugin_dir.join('scripts').islink()
+    assert plugin_dir.join('plugin.py').check(link=0)
+    assert plugin_dir.join('plugin.py').read() == 'print 2'
+    manifest = pb_tool.read_manifest(str(plugin_dir))
+    assert pb_tool.verify_deployment(str(plugin_dir), manifest) == (
+        [], [], [])
+
+
+def test_redeploy_config(tmpdir):
+    source = tmpdir.mkdir('source')
+    source.join('plugin.py').write('print 1')
+    source.join('icon2.png').write('png')
+    for (mode, link) in [('copy', 0), ('symlink', 1)]:
+        plugin_dir = tmpdir.join(mode)
+        with source.as_cwd():
+            pb_tool.install_files(str(plugin_dir),
+                                  plugin_config(python_files='plugin.py'),
+                                  mode)
+            assert pb_tool.deployed_link_mode(str(plugin_dir)) == mode
+            pb_tool.redeploy_config(plugin_config(python_files='plugin.py',
+                                                  extras='icon2.png'),
+                                    [str(plugin_dir)])
+        assert plugin_dir.join('icon2.png').check(file=1, link=link)
+        assert plugin_dir.join('plugin.py').check(file=1, link=link)
+
+
+def test_build_cache(tmpdir):
+    source = tmpdir.join('dialog.ui')
+    output = tmpdir.join('dialog.py')
+    source.write('<ui/>')
+    output.write('')
+    cache = pb_tool.BuildCache(str(tmpdir.join('.pb_tool')))
+    fingerprint = cache.fingerprint([str(source)], sys.executable)
+    cache.record('dialog', fingerprint)
+    cache.save()
+
+    cache = pb_tool.BuildCache(str(tmpdir.join('.pb_tool')))
+    assert cache.is_current('dialog', fingerprint, [str(output)])
+    source.write('<ui version="4.0"/>')
+    assert not cache.is_current(
+        'dialog', cache.fingerprint([str(source)], sys.executable),
+        [str(output)])
+
+    # same size and mtime, as a checkout or cache restore can leave it
+    os.utime(str(source), (1000000000, 1000000000))
+    digest = cache.file_hash(str(source))
+    source.write('<ui version="5.0"/>')
+    os.utime(str(source), (1000000000, 1000000000))
+    assert cache.file_hash(str(source)) != digest
+
+
+def test_strings(tmpdir):
+    source = tmpdir.join('plugin.py')
+    source.write("class Plugin:\n"
+                 "    def run(self):\n"
+                 "        self.tr(u'Hello')\n"
+                 "        QCoreApplication.translate('Other', 'Bye')\n")
+    messages = pb_tool.python_strings(str(source))
+    assert messages == [['Plugin', 'Hello', str(source), 3],
+                        ['Other', 'Bye', str(source), 4]]
+
+    ts_file = tmpdir.mkdir('i18n').join('af.ts')
+    assert pb_tool.update_ts(str(ts_file), messages) == (2, 0)
+    assert pb_tool.update_ts(str(ts_file), messages) == (None, None)
+    assert pb_tool.update_ts(str(ts_file), messages[:1]) == (0, 1)
+    assert 'type="obsolete"' in ts_file.read()
+
+def test_producers():
+    targets = [pb_tool.Target('foo.py', 'ui', ['foo.ui'], ['foo.py'], None),
+               pb_tool.Target('i18n/af.qm', 'translation', ['i18n/af.ts'],
+                              ['i18n/af.qm'], None)]
+    assert pb_tool.producers(targets, 'foo.py') == ['foo.py']
+    assert pb_tool.producers(targets, 'i18n') == ['i18n/af.qm']
+    assert pb_tool.producers(targets, 'icon.png') == []
+
+
+def test_installer_sync(tmpdir):
+    source = tmpdir.mkdir('src').join('plugin.py')
+    source.write('print 1')
+    plugin_dir = tmpdir.join('plugins', 'Test')
+    with tmpdir.join('src').as_cwd():
+        installer = pb_tool.Installer(str(plugin_dir), sync=True)
+        assert installer.copy('plugin.py', 'plugin.py')
+        assert not installer.copy('plugin.py', 'plugin.py')
+        plugin_dir.join('stale.py').write('')
+        assert installer.remove_stale(set(['plugin.py'])) == 1
+    assert plugin_dir.listdir() == [plugin_dir.join('plugin.py')]
+    assert (installer.copied, installer.unchanged) == (1, 1)
+
+
+def test_sync_without_help(tmpdir):
+    # the help was never built, so the help deployed before is stale
+    tmpdir.mkdir('src').join('plugin.py').write('print 1')
+    plugin_dir = tmpdir.join('plugins', 'Test')
+    plugin_dir.ensure('help', 'index.html')
+    with tmpdir.join('src').as_cwd():
+        installer = pb_tool.Installer(str(plugin_dir), sync=True)
+        installer.install_file('plugin.py')
+        assert installer.finish(plugin_config(python_files='plugin.py'))
+    assert sorted(plugin_dir.listdir()) == [
+        plugin_dir.join(pb_tool.MANIFEST), plugin_dir.join('plugin.py')]
+
+
+def test_install_copy(tmpdir):
+    source = tmpdir.join('data.csv')
+    source.write('a,b\n1,2\n')
+    for mode in ('copy', 'reflink', 'hardlink', 'auto'):
+        dest = tmpdir.join(mode + '.csv')
+        assert pb_tool.install_copy(str(source), str(dest), mode) in (
+            'copy', 'reflink', 'hardlink', 'copy_file_range')
+        assert dest.read() == source.read()
+    installer = pb_tool.Installer(str(tmpdir.join('Test')),
+                                  link_mode='symlink')
+    with tmpdir.as_cwd():
+        installer.install_file('missing.py')
+    assert len(installer.errors) == 1
+    assert not tmpdir.join('Test').listdir()
+
+
+def test_remove_linked_deployment(tmpdir):
+    source = tmpdir.mkdir('src')
+    source.join('plugin.py').write('print 1')
+    plugin_dir = tmpdir.mkdir('Test')
+    plugin_dir.join('plugin.py').mksymlinkto(source.join('plugin.py'))
+    plugin_dir.join('data').mksymlinkto(source)
+    assert pb_tool.remove_tree(str(plugin_dir)) == 2
+    assert not plugin_dir.check()
+    assert source.join('plugin.py').read() == 'print 1'
+
+
+def test_replace_dev_link(tmpdir):
+    source = tmpdir.mkdir('source')
+    source.join('plugin.py').write('print 1')
+    source.ensure('scripts', 'compile-strings.sh')
+    source.ensure('scripts', 'run-env-linux.sh')
+    plugin_dir = tmpdir.join('Test')
+    with source.as_cwd():
+        for (sync, mode) in [(False, 'hardlink'), (True, 'copy')]:
+            linker = pb_tool.Installer(str(plugin_dir), link_mode='symlink')
+            linker.install_dir('scripts', 'scripts', 'scripts',
+                               'Error copying directory')
+            assert plugin_dir.join('scripts').islink()
+            installer = pb_tool.Installer(str(plugin_dir), sync=sync,
+                                          link_mode=mode, jobs=2)
+            installer.install_dir('scripts', 'scripts', 'scripts',
+                                  'Error copying directory')
+            assert installer.errors == []
+            assert not plugin_dir.join('scripts').islink()
+            assert plugin_dir.join('scripts', 'run-env-linux.sh').check(
+                file=1, link=0)
+            assert sorted(source.join('scripts').listdir()) == [
+                source.join('scripts', 'compile-strings.sh'),
+                source.join('scripts', 'run-env-linux.sh')]
+        for mode in ('copy', 'hardlink'):
+            linker = pb_tool.Installer(str(plugin_dir), link_mode='symlink')
+            linker.install_file('plugin.py')
+            installer = pb_tool.Installer(str(plugin_dir), sync=True,
+                                          link_mode=mode)
+            assert installer.copy('plugin.py', 'plugin.py')
+            assert plugin_dir.join('plugin.py').check(file=1, link=0)
+
+
+def test_installer_threads(tmpdir):
+    names = ['f{0}.py'.format(i) for i in range(20)]
+    for name in names:
+        tmpdir.join(name).write(name)
+    installer = pb_tool.Installer(str(tmpdir.join('Test')), jobs=4)
+    with tmpdir.as_cwd():
+        installer.install_files(names + ['missing.py'])
+    assert installer.copied == 20
+    assert installer.errors == [
+        'Error copying files: missing.py, No such file or directory']
+
+
+def test_copy_dir(tmpdir):
+    src = tmpdir.mkdir('extra')
+    src.ensure('data', 'points.csv')
+    src.ensure('data', 'points.csv.swp')
+    src.ensure('__pycache__', 'util.cpython-37.pyc')
+    src.ensure('util.pyc')
+    src.ensure('empty', dir=True)
+    assert pb_tool.tree_files(str(src), include_dirs=True) == [
+        'data', 'empty', os.path.join('data', 'points.csv')]
+    dest = tmpdir.join('Test', 'extra')
+    pb_tool.copy_dir(str(src), str(dest))
+    dest.join('data').remove()
+    pb_tool.copy_dir(str(src), str(dest))
+    assert dest.join('data', 'points.csv').check(file=1)
+    assert sorted(dest.listdir()) == [dest.join('data'), dest.join('empty')]
+
+
+def test_file_list(tmpdir):
+    for path in ['plugin.py', 'core/__init__.py', 'core/tools/util.py',
+                 'test/test_core.py', '.hidden/x.py', 'icons/a.png']:
+        tmpdir.ensure(*path.split('/'))
+    cfg = plugin_config(python_files='**/*.py !test/** extra.py',
+                        extras='icons/**')
+    with tmpdir.as_cwd():
+        pb_tool.reset_file_index()
+        assert pb_tool.file_list(cfg, 'python_files') == [
+            os.path.join('core', '__init__.py'),
+            os.path.join('core', 'tools', 'util.py'),
+            'plugin.py', 'extra.py']
+        assert pb_tool.file_list(cfg, 'extras') == [
+            os.path.join('icons', 'a.png')]
+
+
+def test_package_plugin(tmpdir):
+    for path in ['plugin.py', 'metadata.txt', 'i18n/af.qm',
+                 'help/build/html/index.html']:
+        tmpdir.ensure(*path.split('/'))
+    cfg = plugin_config(python_files='plugin.py', extras='metadata.txt',
+                        extra_dirs='i18n')
+    archive = str(tmpdir.join('Test.zip'))
+    with tmpdir.as_cwd():
+        pb_tool.package_plugin(cfg, 'Test', archive)
+    assert pb_tool.zipfile.ZipFile(archive).namelist() == [
+        'Test/', 'Test/help/', 'Test/help/index.html', 'Test/i18n/',
+        'Test/i18n/af.qm', 'Test/metadata.txt', 'Test/plugin.py']
+    assert sorted(tmpdir.listdir()) == sorted(
+        [tmpdir.join(name) for name in
+         ['Test.zip', 'plugin.py', 'metadata.txt', 'i18n', 'help']])
+
+
+def test_reproducible_package(tmpdir, monkeypatch):
+    tmpdir.join('dialog.ui').write('<ui/>')
+    tmpdir.join('dialog.py').write(
+        '# -*- coding: utf-8 -*-\n#\n# Created: Mon Jan 5 10:00:00 2015\n'
+        '#      by: PyQt4 UI code generator 4.11.3\n\nimport os\n')
+    cfg = plugin_config('help', compiled_ui_files='dialog.ui')
+    monkeypatch.setenv('SOURCE_DATE_EPOCH', '1500000000')
+    date_time = pb_tool.archive_date_time()
+    assert date_time == (2017, 7, 14, 2, 40, 0)
+    archives = []
+    with tmpdir.as_cwd():
+        for mtime in (1000000000, 1100000000):
+            os.utime('dialog.py', (mtime, mtime))
+            archive = str(tmpdir.join('Test{0}.zip'.format(len(archives))))
+            pb_tool.package_plugin(cfg, 'Test', archive, date_time)
+            archives.append(open(archive, 'rb').read())
+    assert archives[0] == archives[1]
+    package = pb_tool.zipfile.ZipFile(str(tmpdir.join('Test0.zip')))
+    assert package.read('Test/dialog.py') == (
+        '# -*- coding: utf-8 -*-\n#\n\nimport os\n')
+    assert package.getinfo('Test/dialog.py').external_attr == 0o100644 << 16
+
+
+def test_write_file(tmpdir):
+    data = ''.join(str(n * 7 % 1013) for n in range(100000))
+    tmpdir.join('grid.asc').write(data)
+    archives = []
+    for name in ('streamed.zip', 'whole.zip'):
+        info = pb_tool.archive_entry('Test/grid.asc', (2000, 1, 1, 0, 0, 0),
+                                     0o100644)
+        with pb_tool.zipfile.ZipFile(str(tmpdir.join(name)), 'w') as package:
+            if name == 'streamed.zip':
+                pb_tool.write_file(package, info, str(tmpdir.join('grid.asc')))
+            else:
+                package.writestr(info, data)
+        archives.append(tmpdir.join(name).read('rb'))
+    assert archives[0] == archives[1]
+    package = pb_tool.zipfile.ZipFile(str(tmpdir.join('streamed.zip')))
+    assert package.testzip() is None
+    assert package.read('Test/grid.asc') == data
+
+
+def test_parallel_package(tmpdir, monkeypatch):
+    # the larger files are streamed rather than deflated on the pool
+    monkeypatch.setattr(pb_tool, 'PARALLEL_SIZE_LIMIT', 150000)
+    data = tmpdir.mkdir('data')
+    for i in range(6):
+        data.join('grid{0}.asc'.format(i)).write(
+            '\n'.join(str(n * i % 997) for n in range(50000)))
+    members = [(str(data), 'Test/data')] + [
+        (str(path), 'Test/data/' + path.basename)
+        for path in sorted(data.listdir())]
+    archives = []
+    for processes in (1, 3):
+        archive = str(tmpdir.join('Test{0}.zip'.format(processes)))
+        with pb_tool.zipfile.ZipFile(archive, 'w') as package:
+            if processes == 1:
+                pb_tool.write_members(package, members, (2000, 1, 1, 0, 0, 0))
+            else:
+                pb_tool.write_parallel(package, members, (2000, 1, 1, 0, 0, 0),
+                                       processes=processes)
+        archives.append(open(archive, 'rb').read())
+    assert archives[0] == archives[1]
+    package = pb_tool.zipfile.ZipFile(str(tmpdir.join('Test3.zip')))
+    assert package.testzip() is None
+    assert package.read('Test/data/grid5.asc') == (
+        data.join('grid5.asc').read())
+
+
+def test_installer_threads_share_directories(tmpdir):
+    names = [os.path.join('sub', 'dir', 'f{0}.py'.format(i))
+             for i in range(40)]
+    for name in names:
+        tmpdir.ensure(name)
+    installer = pb_tool.Installer(str(tmpdir.join('Test')), jobs=8)
+    with tmpdir.as_cwd():
+        installer.install_files(names)
+    assert installer.errors == []
+    assert installer.copied == 40
+
+
+def test_install_targets_share_the_pool(tmpdir, monkeypatch):
+    for i in range(10):
+        tmpdir.ensure('data', 'f{0}.csv'.format(i))
+    cfg = plugin_config('data', extra_dirs='data')
+    pools = []
+    run_jobs = pb_tool.run_jobs
+
+    def counted(func, items, jobs=1):
+        pools.append(jobs)
+        return run_jobs(func, items, jobs)
+    monkeypatch.setattr(pb_tool, 'run_jobs', counted)
+    plugin_dir = tmpdir.join('Test')
+    with tmpdir.as_cwd():
+        results = pb_tool.build_targets(
+            pb_tool.BuildCache(),
+            pb_tool.install_targets(cfg, [], str(plugin_dir)), jobs=4)
+    assert set(results.values()) == set(['built'])
+    assert pools == [1, 1]
+    assert len(plugin_dir.join('help').listdir()) == 10
+
+
+def test_parallel_package_matches_serial(tmpdir):
+    tmpdir.join('plugin.py').write('import os\n')
+    tmpdir.join('dialog.ui').write('<ui/>')
+    tmpdir.join('dialog.py').write(
+        '# Created: Mon Jan 5 10:00:00 2015\n'
+        '#      by: PyQt4 UI code generator 4.11.3\nimport os\n')
+    for i in range(8):
+        tmpdir.ensure('data', 'grid{0}.asc'.format(i)).write(
+            ' '.join(str(n * i % 499) for n in range(20000)))
+    tmpdir.ensure('data', 'empty', dir=True)
+    cfg = plugin_config('help', python_files='plugin.py',
+                        compiled_ui_files='dialog.ui', extra_dirs='data')
+    with tmpdir.as_cwd():
+        for date_time in (None, (2010, 6, 1, 12, 0, 0)):
+            archives = []
+            for processes in (1, 3):
+                archive = str(tmpdir.join('Test{0}.zip'.format(processes)))
+                pb_tool.package_plugin(cfg, 'Test', archive, date_time,
+                                       processes)
+                archives.append(open(archive, 'rb').read())
+            assert archives[0] == archives[1]
+    assert pb_tool.zipfile.ZipFile(archive).testzip() is None
+
+
+def test_parallel_duplicate_warning(tmpdir):
+    tmpdir.join('a.txt').write('a')
+    members = [(str(tmpdir.join('a.txt')), 'Test/a.txt')] * 2
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        with pb_tool.zipfile.ZipFile(str(tmpdir.join('Test.zip')),
+                                     'w') as package:
+            pb_tool.write_parallel(package, members, processes=2)
+    assert any('Duplicate name' in str(warning.message)
+               for warning in caught)
+
+
+def test_swap_in(tmpdir):
+    plugin_dir = tmpdir.mkdir('Test')
+    plugin_dir.join('old.py').write('')
+    staging = tmpdir.join(os.path.basename(
+        pb_tool.staging_dir(str(plugin_dir))))
+    staging.ensure('new.py')
+    pb_tool.swap_in(str(staging), str(plugin_dir))
+    assert plugin_dir.listdir() == [plugin_dir.join('new.py')]
+    assert tmpdir.listdir() == [plugin_dir]
+
+
+def test_verify_deployment(tmpdir):
+    plugin_dir = tmpdir.mkdir('Test')
+    plugin_dir.join('plugin.py').write('print 1')
+    plugin_dir.join('icon.png').write('png')
+    pb_tool.write_manifest(str(plugin_dir), ['plugin.py', 'icon.png'])
+    manifest = pb_tool.read_manifest(str(plugin_dir))
+    assert pb_tool.verify_deployment(str(plugin_dir), manifest) == (
+        [], [], [])
+    plugin_dir.ensure('plugin.pyc')
+    plugin_dir.ensure('__pycache__', 'plugin.cpython-37.pyc')
+    assert pb_tool.verify_deployment(str(plugin_dir), manifest) == (
+        [], [], [])
+    plugin_dir.join('plugin.py').write('print 2')
+    plugin_dir.join('icon.png').remove()
+    plugin_dir.join('notes.txt').write('')
+    assert pb_tool.verify_deployment(str(plugin_dir), manifest, True) == (
+        ['icon.png'], ['plugin.py'], ['notes.txt'])
+    pb_tool.update_manifest(str(plugin_dir), ['plugin.py', 'notes.txt'])
+    manifest = pb_tool.read_manifest(str(plugin_dir))
+    assert sorted(manifest) == ['notes.txt', 'plugin.py']
+    assert pb_tool.verify_deployment(str(plugin_dir), manifest, True) == (
+        [], [], [])
+
+
+def test_plugin_directories():
+    cfg = pb_tool.get_config()
+    assert pb_tool.plugin_directories(cfg, ['/a', '/b']) == [
+        '/a/TestPlugin', '/b/TestPlugin']
+    assert pb_tool.plugin_directories(cfg, ['/a', '/b', '/a/', '/a']) == [
+        '/a/TestPlugin', '/b/TestPlugin']
+    cfg.set('plugin', 'plugin_path', os.pathsep.join(['/qgis2', '/qgis 3']))
+    assert pb_tool.plugin_directories(cfg) == [
+        '/qgis2/TestPlugin', '/qgis 3/TestPlugin']
+    cfg.set('plugin', 'plugin_path', '\n/qgis2\n/My Plugins')
+    assert pb_tool.plugin_directories(cfg) == [
+        '/qgis2/TestPlugin', '/My Plugins/TestPlugin']
+
+
+def test_qgis_profiles(tmpdir, monkeypatch):
+    profiles = tmpdir.join('profiles')
+    profiles.ensure('default', dir=True)
+    profiles.ensure('work', dir=True)
+    profiles.join('profiles.ini').write('[core]\ndefaultProfile=work\n')
+    monkeypatch.setenv('QGIS_CUSTOM_CONFIG_PATH', str(tmpdir))
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir.join('cache')))
+    # QGIS 2 stays the default until the config asks for QGIS 3
+    assert pb_tool.get_plugin_directory() == str(
+        tmpdir.join('python', 'plugins'))
+    assert pb_tool.get_plugin_directory(3) == str(
+        profiles.join('work', 'python', 'plugins'))
+    cfg = plugin_config()
+    cfg.add_section('plugin')
+    cfg.set('plugin', 'name', 'Test')
+    assert pb_tool.plugin_directories(cfg) == [
+        str(tmpdir.join('python', 'plugins', 'Test'))]
+    cfg.set('plugin', 'qgis_version', '3')
+    assert pb_tool.plugin_directories(cfg) == [
+        str(profiles.join('work', 'python', 'plugins', 'Test'))]
+    assert tmpdir.join('cache', 'pb_tool', 'profiles.json').check()
+    profiles.ensure('test', dir=True)
+    assert [name for (version, name, path, default)
+            in pb_tool.qgis_profiles() if version == 3] == [
+        'default', 'test', 'work']
+
 
 #    results.append("Command validate failed: {}".format(result.output))
 #print("testing validate: {}".format(result))